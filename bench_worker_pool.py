@@ -0,0 +1,56 @@
+"""Compare pickled results against shared memory handoff for the scrape worker pool.
+
+Usage: python bench_worker_pool.py [--tasks N] [--pages N] [--workers-per-core N]
+"""
+import argparse
+import json
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from worker_pool import SharedResult, _synthetic_worker, worker_count
+
+
+def run_pickled(executor, tasks, pages):
+    total = 0
+    futures = [executor.submit(_synthetic_worker, pages, False) for _ in range(tasks)]
+    for future in futures:
+        # The API process still has to encode the unpickled result for the response
+        total += len(json.dumps(future.result()).encode('utf-8'))
+    return total
+
+
+def run_shared(executor, tasks, pages):
+    total = 0
+    futures = [executor.submit(_synthetic_worker, pages, True) for _ in range(tasks)]
+    for future in futures:
+        # Stream the bytes as the API does, without copying the whole payload or decoding it in the parent
+        shared = SharedResult(*future.result())
+        try:
+            for chunk in shared.iter_chunks():
+                total += len(chunk)
+        finally:
+            shared.release()
+    return total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--tasks', type=int, default=64)
+    parser.add_argument('--pages', type=int, default=40)
+    parser.add_argument('--workers-per-core', type=float, default=1)
+    args = parser.parse_args()
+
+    workers = worker_count(args.workers_per_core)
+    print(f"{workers} workers, {args.tasks} tasks, {args.pages} item_list pages per result")
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # Warm up the worker processes so start-up cost isn't measured
+        list(executor.map(_synthetic_worker, [1] * workers, [False] * workers))
+        for label, runner in (("pickle", run_pickled), ("shared memory", run_shared)):
+            start = time.perf_counter()
+            runner(executor, args.tasks, args.pages)
+            elapsed = time.perf_counter() - start
+            print(f"{label:>14}: {elapsed:.3f}s total, {elapsed / args.tasks * 1000:.1f} ms/task")
+
+
+if __name__ == '__main__':
+    main()
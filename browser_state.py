@@ -0,0 +1,182 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+import shared_state
+from rate_limiter import rate_limiter, proxy_key, BLOCKED
+
+logger = logging.getLogger('scraper_logger')
+
+BROWSER_STATE_DIR = os.environ.get('BROWSER_STATE_DIR', 'browser_state')
+STATE_TTL = float(os.environ.get('STATE_TTL', str(6 * 3600)))  # seconds
+STATE_REFRESH_INTERVAL = float(os.environ.get('STATE_REFRESH_INTERVAL', '600'))
+# Cookies TikTok sets on the first visit; without them every scrape repeats the warm-up
+REQUIRED_COOKIES = tuple(os.environ.get('STATE_REQUIRED_COOKIES', 'ttwid').split(','))
+WARMUP_URL = "https://www.tiktok.com/"
+USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+
+
+def _is_valid(state, now):
+    cookies = [cookie for cookie in state.get("cookies", []) if "tiktok.com" in cookie.get("domain", "")]
+    live = {cookie["name"] for cookie in cookies
+            if cookie.get("expires", -1) in (-1, None) or cookie["expires"] > now}
+    return all(name in live for name in REQUIRED_COOKIES)
+
+
+def cookies_from_selenium(cookies):
+    """Convert driver.get_cookies() output into Playwright storage_state cookies"""
+    return [
+        {
+            "name": cookie["name"],
+            "value": cookie["value"],
+            "domain": cookie.get("domain", ".tiktok.com"),
+            "path": cookie.get("path", "/"),
+            "expires": cookie.get("expiry", -1),
+            "httpOnly": cookie.get("httpOnly", False),
+            "secure": cookie.get("secure", False),
+            "sameSite": cookie.get("sameSite", "Lax"),
+        }
+        for cookie in cookies
+    ]
+
+
+def cookies_for_selenium(state):
+    """Convert storage_state cookies into dicts accepted by driver.add_cookie()"""
+    converted = []
+    for cookie in state.get("cookies", []):
+        entry = {
+            "name": cookie["name"],
+            "value": cookie["value"],
+            "domain": cookie["domain"],
+            "path": cookie.get("path", "/"),
+            "secure": cookie.get("secure", False),
+            "httpOnly": cookie.get("httpOnly", False),
+        }
+        if cookie.get("expires", -1) not in (-1, None):
+            entry["expiry"] = int(cookie["expires"])
+        converted.append(entry)
+    return converted
+
+
+class StorageStateCache:
+    """Per proxy identity snapshots of Playwright ``storage_state`` on disk.
+
+    Snapshots are validated before use (age and required cookies), dropped as
+    soon as the rate limiter records a block for that identity, and refreshed
+    in the background before they go stale. Only identities a scrape has saved
+    state for are refreshed. Identities come from ``proxy_key``, so a BrowserMob
+    relay shares the snapshot of the upstream it egresses through.
+    """
+
+    def __init__(self, root=BROWSER_STATE_DIR, ttl=STATE_TTL):
+        self.root = root
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._identities = set()
+
+    def _path(self, identity):
+        return os.path.join(self.root, hashlib.sha1(identity.encode()).hexdigest() + ".json")
+
+    def _read(self, identity):
+        try:
+            with open(self._path(identity)) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def get(self, proxy=None):
+        """Return a usable storage_state for the proxy identity, or None"""
+        identity = proxy_key(proxy)
+        with self._lock:
+            snapshot = self._read(identity)
+        if snapshot is None:
+            return None
+        now = time.time()
+        if now - snapshot["saved_at"] > self.ttl or not _is_valid(snapshot["state"], now):
+            logger.info(f"Stored browser state for {identity} is stale, not using it")
+            self.invalidate(proxy)
+            return None
+        return snapshot["state"]
+
+    def age(self, proxy=None):
+        snapshot = self._read(proxy_key(proxy))
+        return None if snapshot is None else time.time() - snapshot["saved_at"]
+
+    def save(self, proxy, state):
+        identity = proxy_key(proxy)
+        if rate_limiter.is_flagged(proxy):
+            logger.warning(f"Not saving browser state for flagged identity {identity}")
+            return False
+        if not _is_valid(state, time.time()):
+            logger.debug(f"Browser state for {identity} lacks {REQUIRED_COOKIES}, not saving")
+            return False
+        path = self._path(identity)
+        with self._lock:
+            self._identities.add(identity)
+            os.makedirs(self.root, exist_ok=True)
+            with open(path + ".tmp", "w") as f:
+                json.dump({"identity": identity, "saved_at": time.time(), "state": state}, f)
+            os.replace(path + ".tmp", path)
+        logger.info(f"Saved browser state for {identity}")
+        return True
+
+    def invalidate(self, proxy=None):
+        identity = proxy_key(proxy)
+        with self._lock:
+            try:
+                os.remove(self._path(identity))
+                logger.info(f"Invalidated browser state for {identity}")
+            except FileNotFoundError:
+                pass
+
+    async def refresh(self, proxy=None):
+        """Visit TikTok once in a fresh context and store the resulting state"""
+        from playwright.async_api import async_playwright
+
+        identity = proxy_key(proxy)
+        launch_options = {"headless": True}
+        if proxy:
+            launch_options["proxy"] = {"server": identity}
+        async with async_playwright() as p:
+            browser = await p.chromium.launch(**launch_options)
+            try:
+                context = await browser.new_context(user_agent=USER_AGENT, storage_state=self.get(proxy))
+                page = await context.new_page()
+                await rate_limiter.acquire(proxy, "profile")
+                await page.goto(WARMUP_URL, wait_until="domcontentloaded", timeout=30000)
+                # Give the verification / consent scripts time to set their cookies
+                await page.wait_for_timeout(3000)
+                if rate_limiter.observe(proxy, "profile", 200, await page.content()) == BLOCKED:
+                    return False
+                return self.save(proxy, await context.storage_state())
+            finally:
+                await browser.close()
+
+    async def refresh_loop(self, interval=STATE_REFRESH_INTERVAL):
+        """Keep snapshots of identities that scrapes have used younger than half the TTL"""
+        while True:
+            # Nothing to refresh until a scrape has saved state, so the first pass waits too
+            await asyncio.sleep(interval)
+            for identity in sorted(self._identities):
+                proxy = None if identity == "direct" else identity
+                age = self.age(proxy)
+                if age is not None and age < self.ttl / 2:
+                    continue
+                try:
+                    refreshed = await self.refresh(proxy)
+                except Exception as e:
+                    logger.error(f"Background browser state refresh failed for {identity}: {e}")
+                    refreshed = False
+                if not refreshed:
+                    # Tracked again by the next scrape that saves state through it
+                    with self._lock:
+                        self._identities.discard(identity)
+
+state_cache = shared_state.remote("state_cache")
+if state_cache is None:
+    state_cache = StorageStateCache()
+    rate_limiter.add_block_listener(lambda proxy, endpoint: state_cache.invalidate(proxy))
@@ -0,0 +1,136 @@
+import asyncio
+import json
+import logging
+import os
+
+from posts import parse_item
+from rate_limiter import endpoint_for_url
+
+logger = logging.getLogger('scraper_logger')
+
+# Raw response bytes a single scrape may capture before it stops keeping pages
+CAPTURE_MAX_BYTES = int(os.environ.get('CAPTURE_MAX_BYTES', str(64 * 1024 * 1024)))
+# Longest a route handler waits on the sink before it drops the page and fulfills the request
+CAPTURE_SINK_TIMEOUT = float(os.environ.get('CAPTURE_SINK_TIMEOUT', '30'))  # seconds
+
+USER_FIELDS = ("id", "uniqueId", "nickname", "signature", "verified", "secUid", "avatarThumb", "privateAccount")
+
+
+def reduce_body(endpoint, body):
+    """Keep only the fields the service returns from an intercepted response"""
+    if endpoint == "item_list":
+        return {
+            "itemList": [parse_item(post) for post in body.get("itemList") or []],
+            "hasMore": body.get("hasMore"),
+            "cursor": body.get("cursor"),
+        }
+    if endpoint == "user_detail":
+        user_info = body.get("userInfo") or {}
+        user = user_info.get("user") or {}
+        return {"userInfo": {"user": {field: user.get(field) for field in USER_FIELDS},
+                             "stats": user_info.get("stats")}}
+    return body
+
+
+class CaptureSink:
+    """Consumer of captured pages.
+
+    ``put`` is awaited from the route handler before the intercepted request is
+    fulfilled, so a sink that blocks slows the page's own requests down too.
+    ``Capture`` gives up on a ``put`` after ``CAPTURE_SINK_TIMEOUT`` seconds.
+    """
+
+    async def put(self, page, size):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class ListSink(CaptureSink):
+    """Keep the reduced pages in memory, for callers that want the whole result at once"""
+
+    def __init__(self):
+        self.pages = []
+
+    async def put(self, page, size):
+        self.pages.append(page)
+
+
+class StatsSink(CaptureSink):
+    """Record the stats of every captured ``item_list`` page, then pass the page on to ``inner``.
+
+    Recording runs in the default executor so a snapshot compaction never
+    blocks the event loop.
+    """
+
+    def __init__(self, store, inner=None):
+        self.store = store
+        self.inner = inner
+
+    async def put(self, page, size):
+        if page["endpoint"] == "item_list":
+            posts = page["response_body"]["itemList"]
+            await asyncio.get_running_loop().run_in_executor(None, self.store.record_posts, posts)
+        if self.inner is not None:
+            await self.inner.put(page, size)
+
+    async def close(self):
+        if self.inner is not None:
+            await self.inner.close()
+
+
+class Capture:
+    """Per-scrape capture of intercepted API responses.
+
+    Each response is decoded, reduced to the fields we return and forwarded to
+    the sink straight away; the full body is not kept. Once ``max_bytes`` of
+    raw responses have been captured further pages are dropped and ``full`` is
+    set so the scroll loop can stop asking for more. A page the sink does not
+    accept within ``sink_timeout`` seconds is dropped too.
+    """
+
+    def __init__(self, sink=None, max_bytes=CAPTURE_MAX_BYTES, sink_timeout=CAPTURE_SINK_TIMEOUT):
+        self.sink = sink if sink is not None else ListSink()
+        self.max_bytes = max_bytes
+        self.sink_timeout = sink_timeout
+        self.captured_bytes = 0
+        self.pages = 0
+        self.dropped = 0
+        self.full = False
+        self.has_more = None
+
+    async def offer(self, url, status, body_text):
+        """Decode, reduce and forward one response; returns False if it was not kept"""
+        size = len(body_text)
+        if self.captured_bytes + size > self.max_bytes:
+            if not self.full:
+                logger.warning(f"Capture limit of {self.max_bytes} bytes reached, dropping further pages")
+            self.full = True
+            self.dropped += 1
+            return False
+        endpoint = endpoint_for_url(url)
+        body = reduce_body(endpoint, json.loads(body_text))
+        if endpoint == "item_list":
+            self.has_more = body["hasMore"]
+        page = {"url": url, "endpoint": endpoint, "response_status": status, "response_body": body}
+        try:
+            await asyncio.wait_for(self.sink.put(page, size), self.sink_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Capture sink did not accept {url} within {self.sink_timeout}s, dropping it")
+            self.dropped += 1
+            return False
+        self.captured_bytes += size
+        self.pages += 1
+        return True
+
+    def exhausted(self):
+        """True once the profile reported no further pages or the byte cap was hit"""
+        return self.full or self.has_more is False
+
+    async def close(self):
+        await self.sink.close()
+
+    def summary(self):
+        return {"pages": self.pages, "captured_bytes": self.captured_bytes, "dropped": self.dropped,
+                "truncated": self.full}
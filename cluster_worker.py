@@ -0,0 +1,167 @@
+"""Worker node loop for coordinator mode.
+
+Runs inside the API process when CLUSTER_ROLE=worker, or standalone for local
+testing with several processes on one machine:
+
+    CLUSTER_ROLE=coordinator uvicorn main:app --port 8000
+    python cluster_worker.py --coordinator http://localhost:8000 --worker-id w1 --fake
+    python cluster_worker.py --coordinator http://localhost:8000 --worker-id w2 --fake
+"""
+import argparse
+import logging
+import os
+import random
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+logger = logging.getLogger('main_logger')
+
+COORDINATOR_URL = os.environ.get('COORDINATOR_URL', 'http://localhost:8000')
+WORKER_ID = os.environ.get('WORKER_ID', f"{socket.gethostname()}-{os.getpid()}")
+WORKER_URL = os.environ.get('WORKER_URL', f"http://{socket.gethostname()}:{os.environ.get('PORT', '8000')}")
+BROWSER_POOL_SIZE = int(os.environ.get('BROWSER_POOL_SIZE', '2'))
+POLL_INTERVAL = float(os.environ.get('POLL_INTERVAL', '2'))
+HEARTBEAT_INTERVAL = float(os.environ.get('HEARTBEAT_INTERVAL', '10'))
+
+
+def default_scrape(username):
+    from main import setup_and_scrape
+    return setup_and_scrape(username)
+
+
+def fake_scrape(username):
+    """Stand-in scrape for exercising the scheduler without browsers"""
+    time.sleep(random.uniform(0.5, 2))
+    return {"username": username, "videos": [], "xhr_data": []}
+
+
+class ClusterWorker:
+    def __init__(self, coordinator_url=COORDINATOR_URL, worker_id=WORKER_ID, worker_url=WORKER_URL,
+                 capacity=BROWSER_POOL_SIZE, scrape=default_scrape):
+        self.coordinator_url = coordinator_url.rstrip('/')
+        self.worker_id = worker_id
+        self.worker_url = worker_url
+        self.capacity = capacity
+        self.scrape = scrape
+        self.session = requests.Session()
+        self.executor = ThreadPoolExecutor(max_workers=capacity)
+        self.in_flight = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+
+    def _post(self, path, payload):
+        response = self.session.post(f"{self.coordinator_url}{path}", json=payload, timeout=10)
+        response.raise_for_status()
+        return response.json()
+
+    def register(self):
+        self._post("/cluster/workers", {
+            "worker_id": self.worker_id,
+            "url": self.worker_url,
+            "capacity": self.capacity,
+        })
+        logger.info(f"Worker {self.worker_id} registered with {self.coordinator_url}")
+
+    def free_capacity(self):
+        with self._lock:
+            return self.capacity - len(self.in_flight)
+
+    def heartbeat(self):
+        with self._lock:
+            job_ids = list(self.in_flight)
+        data = self._post("/cluster/heartbeat", {
+            "worker_id": self.worker_id,
+            "free_capacity": self.capacity - len(job_ids),
+            "job_ids": job_ids,
+        })
+        if not data.get("known"):
+            # The coordinator restarted or dropped us as dead
+            self.register()
+
+    def run_job(self, job):
+        result, error = None, None
+        try:
+            result = self.scrape(job["username"])
+            if not result:
+                error = "infra: empty result"
+        except Exception as e:
+            error = f"{getattr(e, 'kind', 'unknown')}: {str(e)}"
+            logger.error(f"Job {job['id']} for {job['username']} failed: {error}")
+        try:
+            self._post("/cluster/complete", {
+                "worker_id": self.worker_id,
+                "job_id": job["id"],
+                "result": result,
+                "error": error,
+            })
+        except requests.RequestException as e:
+            # The lease will expire and the job gets requeued
+            logger.error(f"Could not report job {job['id']}: {e}")
+        finally:
+            with self._lock:
+                self.in_flight.discard(job["id"])
+
+    def poll(self):
+        free = self.free_capacity()
+        if free <= 0:
+            return 0
+        jobs = self._post("/cluster/lease", {"worker_id": self.worker_id, "free_capacity": free}).get("jobs", [])
+        for job in jobs:
+            with self._lock:
+                self.in_flight.add(job["id"])
+            self.executor.submit(self.run_job, job)
+        return len(jobs)
+
+    def run(self):
+        registered = False
+        last_heartbeat = 0.0
+        while not self._stop.is_set():
+            try:
+                if not registered:
+                    # Retried every poll until the coordinator comes up
+                    self.register()
+                    registered = True
+                    last_heartbeat = time.monotonic()
+                if time.monotonic() - last_heartbeat >= HEARTBEAT_INTERVAL:
+                    self.heartbeat()
+                    last_heartbeat = time.monotonic()
+                leased = self.poll()
+            except requests.RequestException as e:
+                logger.error(f"Coordinator unreachable: {e}")
+                leased = 0
+            if not leased:
+                self._stop.wait(POLL_INTERVAL)
+
+    def start(self):
+        thread = threading.Thread(target=self.run, name="cluster-worker", daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self._stop.set()
+        self.executor.shutdown(wait=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--coordinator', default=COORDINATOR_URL)
+    parser.add_argument('--worker-id', default=WORKER_ID)
+    parser.add_argument('--capacity', type=int, default=BROWSER_POOL_SIZE)
+    parser.add_argument('--fake', action='store_true', help="simulate scrapes instead of launching browsers")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    worker = ClusterWorker(args.coordinator, args.worker_id, WORKER_URL, args.capacity,
+                           fake_scrape if args.fake else default_scrape)
+    try:
+        worker.run()
+    except KeyboardInterrupt:
+        worker.stop()
+
+
+if __name__ == '__main__':
+    main()
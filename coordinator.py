@@ -0,0 +1,229 @@
+import collections
+import itertools
+import logging
+import math
+import os
+import threading
+import time
+
+logger = logging.getLogger('main_logger')
+
+# 'standalone' serves /scrape only, 'coordinator' also schedules jobs for workers,
+# 'worker' pulls jobs from COORDINATOR_URL
+CLUSTER_ROLE = os.environ.get('CLUSTER_ROLE', 'standalone').lower()
+LEASE_SECONDS = float(os.environ.get('LEASE_SECONDS', '180'))
+WORKER_TIMEOUT = float(os.environ.get('WORKER_TIMEOUT', '30'))
+MAX_JOB_ATTEMPTS = int(os.environ.get('MAX_JOB_ATTEMPTS', '3'))
+# Seconds a finished or failed job and its result stay available to /cluster/jobs
+JOB_TTL = float(os.environ.get('JOB_TTL', '3600'))
+
+QUEUED = "queued"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+
+
+class Job:
+    def __init__(self, job_id, username):
+        self.id = job_id
+        self.username = username
+        self.state = QUEUED
+        self.worker_id = None
+        self.lease_expires = 0.0
+        self.attempts = 0
+        self.result = None
+        self.error = None
+        self.submitted_at = time.time()
+        self.finished_at = None
+
+    def to_dict(self, include_result=False):
+        data = {
+            "id": self.id,
+            "username": self.username,
+            "state": self.state,
+            "worker_id": self.worker_id,
+            "attempts": self.attempts,
+            "error": self.error,
+        }
+        if include_result:
+            data["result"] = self.result
+        return data
+
+
+class Worker:
+    def __init__(self, worker_id, url, capacity):
+        self.id = worker_id
+        self.url = url
+        self.capacity = capacity
+        self.free_capacity = capacity
+        self.last_seen = time.monotonic()
+
+    def is_alive(self, now):
+        return now - self.last_seen < WORKER_TIMEOUT
+
+
+class Coordinator:
+    """In-process job broker that leases username jobs to worker nodes.
+
+    Workers pull work with their free browser-pool capacity. A username has at
+    most one active job, leases expire if the worker stops renewing them, and
+    jobs held by dead workers go back to the front of the queue. Finished jobs
+    are dropped JOB_TTL seconds after they complete.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self.jobs = {}
+        self.workers = {}
+        self._active_by_username = {}
+        self._queue = collections.deque()
+
+    def submit(self, username):
+        with self._lock:
+            job_id = self._active_by_username.get(username)
+            if job_id is not None:
+                logger.info(f"Job for {username} already active as {job_id}, deduplicated")
+                return self.jobs[job_id]
+            job = Job(str(next(self._ids)), username)
+            self.jobs[job.id] = job
+            self._active_by_username[username] = job.id
+            self._queue.append(job.id)
+            logger.info(f"Queued job {job.id} for {username}")
+            return job
+
+    def register(self, worker_id, url, capacity):
+        with self._lock:
+            worker = self.workers.get(worker_id)
+            if worker is None:
+                worker = self.workers[worker_id] = Worker(worker_id, url, capacity)
+                logger.info(f"Registered worker {worker_id} at {url} with capacity {capacity}")
+            worker.url = url
+            worker.capacity = capacity
+            worker.last_seen = time.monotonic()
+            return worker
+
+    def heartbeat(self, worker_id, free_capacity, job_ids=()):
+        """Record liveness and extend the leases the worker still holds"""
+        with self._lock:
+            worker = self.workers.get(worker_id)
+            if worker is None:
+                return False
+            now = time.monotonic()
+            worker.last_seen = now
+            worker.free_capacity = free_capacity
+            for job_id in job_ids:
+                job = self.jobs.get(job_id)
+                if job and job.state == LEASED and job.worker_id == worker_id:
+                    job.lease_expires = now + LEASE_SECONDS
+            return True
+
+    def lease(self, worker_id, free_capacity):
+        """Hand out up to ``free_capacity`` jobs, sized by the worker's share of free capacity"""
+        with self._lock:
+            worker = self.workers.get(worker_id)
+            if worker is None:
+                return None
+            now = time.monotonic()
+            worker.last_seen = now
+            worker.free_capacity = free_capacity
+            self._reap(now)
+            if free_capacity <= 0 or not self._queue:
+                return []
+
+            # Leave work for idle nodes with more free slots instead of letting the first poller take everything
+            total_free = sum(w.free_capacity for w in self.workers.values() if w.is_alive(now))
+            share = math.ceil(len(self._queue) * free_capacity / max(total_free, free_capacity))
+            count = min(free_capacity, max(1, share))
+
+            leased = []
+            while self._queue and len(leased) < count:
+                job = self.jobs[self._queue.popleft()]
+                job.state = LEASED
+                job.worker_id = worker_id
+                job.lease_expires = now + LEASE_SECONDS
+                job.attempts += 1
+                leased.append(job)
+            worker.free_capacity -= len(leased)
+            if leased:
+                logger.info(f"Leased {len(leased)} jobs to {worker_id}: {[job.id for job in leased]}")
+            return leased
+
+    def complete(self, worker_id, job_id, result=None, error=None):
+        with self._lock:
+            job = self.jobs.get(job_id)
+            if job is None or job.state != LEASED or job.worker_id != worker_id:
+                # The lease expired and the job was requeued or finished elsewhere
+                logger.warning(f"Ignoring stale completion of job {job_id} from {worker_id}")
+                return False
+            if error is not None and job.attempts < MAX_JOB_ATTEMPTS and not error.startswith("not_found"):
+                logger.warning(f"Job {job_id} failed on {worker_id}, requeueing: {error}")
+                self._requeue(job)
+                return True
+            job.state = FAILED if error is not None else DONE
+            job.result = result
+            job.error = error
+            job.finished_at = time.time()
+            self._active_by_username.pop(job.username, None)
+            return True
+
+    def get(self, job_id):
+        with self._lock:
+            return self.jobs.get(job_id)
+
+    def reap(self):
+        with self._lock:
+            self._reap(time.monotonic())
+
+    def _requeue(self, job):
+        job.state = QUEUED
+        job.worker_id = None
+        self._queue.appendleft(job.id)
+
+    def _reap(self, now):
+        dead = {worker.id for worker in self.workers.values() if not worker.is_alive(now)}
+        for job in self.jobs.values():
+            if job.state != LEASED:
+                continue
+            if job.worker_id in dead or job.lease_expires < now:
+                if job.attempts >= MAX_JOB_ATTEMPTS:
+                    logger.error(f"Job {job.id} for {job.username} lost {job.attempts} leases, marking failed")
+                    job.state = FAILED
+                    job.error = "lease expired"
+                    job.finished_at = time.time()
+                    self._active_by_username.pop(job.username, None)
+                else:
+                    logger.warning(f"Lease on job {job.id} held by {job.worker_id} expired, requeueing")
+                    self._requeue(job)
+        for worker_id in dead:
+            logger.warning(f"Worker {worker_id} stopped heartbeating, removing it")
+            del self.workers[worker_id]
+        cutoff = time.time() - JOB_TTL
+        expired = [job.id for job in self.jobs.values()
+                   if job.state in (DONE, FAILED) and job.finished_at < cutoff]
+        for job_id in expired:
+            del self.jobs[job_id]
+        if expired:
+            logger.info(f"Expired {len(expired)} finished jobs")
+
+    def status(self):
+        with self._lock:
+            now = time.monotonic()
+            states = collections.Counter(job.state for job in self.jobs.values())
+            return {
+                "queued": len(self._queue),
+                "jobs": dict(states),
+                "workers": [
+                    {
+                        "id": worker.id,
+                        "url": worker.url,
+                        "capacity": worker.capacity,
+                        "free_capacity": worker.free_capacity,
+                        "alive": worker.is_alive(now),
+                    }
+                    for worker in self.workers.values()
+                ],
+            }
+
+
+coordinator = Coordinator()
@@ -9,54 +9,90 @@ import logging
 import sys
 import os
 from logging.handlers import RotatingFileHandler
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
 from pydantic import BaseModel
-from playwright.async_api import async_playwright, Error as PlaywrightError, TimeoutError as PlaywrightTimeoutError
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.common.by import By
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.common.proxy import Proxy, ProxyType
-from bs4 import BeautifulSoup
+from typing import List, Optional
 import time
-from browsermobproxy import Server  # Changed from browsermob_proxy to browsermobproxy
 import socket
 import subprocess
 import shutil
-import random
-import psutil
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.common.by import By
-from tenacity import retry, stop_after_attempt, wait_exponential, retry_if_exception_type
-import requests
-from selenium.common.exceptions import WebDriverException
-from selenium.webdriver.common.desired_capabilities import DesiredCapabilities
-from selenium.common.exceptions import TimeoutException
-from scraper import get_formatted_proxy_url, setup_proxy_config, scrape_tiktok_profile
+from scraper import setup_proxy_config
+from rate_limiter import rate_limiter, endpoint_for_url, proxy_key, BLOCKED
+from retry_policy import (call_with_retry, async_call_with_retry, ScrapeError, BlockedError,
+                          NotFoundError, InfraError, TransientNetworkError, retry_budget)
+from worker_pool import worker_pool, SharedResult, SCRAPE_POOL_MODE
+from coordinator import coordinator, CLUSTER_ROLE
+from readiness import readiness_probe
+from posts import parse_item, scrape_posts, MAX_POSTS_PER_REQUEST
+from media import get_media_store, media_urls_from_posts, is_allowed_media_url, is_sha256
+from singleflight import scrape_flight, request_key
+from scroll_engine import ScrollEngine
+from browser_state import state_cache, cookies_for_selenium, cookies_from_selenium, STATE_REFRESH_INTERVAL
+from tracing import span, traced, bind, capture as capture_context, restore, start_trace, RequestIdFilter
+from capture import Capture, ListSink, StatsSink
+from stats_store import get_stats_store, stats_store_loaded
+from scheduler import scrape_scheduler, QueueFullError, PRIORITY_CLASSES, DEFAULT_PRIORITY
 
 # Add these environment variable definitions near the top of the file, after the imports
 IS_REMOTE = os.environ.get('IS_REMOTE', 'false').lower() == 'true'
 PROXY_HOST = os.environ.get('PROXY_HOST', 'localhost')
 PROXY_PORT = int(os.environ.get('PROXY_PORT', '8081'))
 WEBDRIVER_URL = os.environ.get('WEBDRIVER_URL', 'http://localhost:4444/wd/hub')
+# host:port BrowserMob relays through; unset, BrowserMob traffic leaves from this host like direct scrapes
+BROWSERMOB_UPSTREAM_PROXY = os.environ.get('BROWSERMOB_UPSTREAM_PROXY', '')
 
 class ScrapeRequest(BaseModel):
     username: str
+    client_id: str = "anonymous"
+    priority: str = DEFAULT_PRIORITY
+
+class PostsRequest(BaseModel):
+    ids: List[str]
+    browser_fallback: bool = True
+
+class MediaRequest(BaseModel):
+    urls: List[str] = []
+    posts: List[dict] = []
+    fields: List[str] = ["cover"]
+
+class ClusterJobsRequest(BaseModel):
+    usernames: List[str]
+
+class RegisterWorkerRequest(BaseModel):
+    worker_id: str
+    url: str
+    capacity: int
+
+class HeartbeatRequest(BaseModel):
+    worker_id: str
+    free_capacity: int
+    job_ids: List[str] = []
+
+class LeaseRequest(BaseModel):
+    worker_id: str
+    free_capacity: int
+
+class CompleteJobRequest(BaseModel):
+    worker_id: str
+    job_id: str
+    result: Optional[dict] = None
+    error: Optional[str] = None
 
 def setup_logger(name: str, log_file: str, level=logging.DEBUG, max_size=1048576, backup_count=5):
     """Function to setup loggers that output to both file and stdout"""
-    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - [%(request_id)s] %(message)s')
+    request_id_filter = RequestIdFilter()
     
     # Rotating File Handler
     file_handler = RotatingFileHandler(log_file, maxBytes=max_size, backupCount=backup_count)
     file_handler.setFormatter(formatter)
+    file_handler.addFilter(request_id_filter)
     
     # Stream handler (for stdout)
     stream_handler = logging.StreamHandler(sys.stdout)
     stream_handler.setFormatter(formatter)
+    stream_handler.addFilter(request_id_filter)
     
     # Setup logger
     logger = logging.getLogger(name)
@@ -66,20 +102,20 @@ def setup_logger(name: str, log_file: str, level=logging.DEBUG, max_size=1048576
     
     return logger
 
-# Initialize loggers
+# Loggers are created here but only get their handlers in configure_logging(),
+# so importing this module doesn't touch the filesystem
 log_dir = "logs"
-if not os.path.exists(log_dir):
-    os.makedirs(log_dir)
+main_logger = logging.getLogger('main_logger')
+scraper_logger = logging.getLogger('scraper_logger')
 
-main_logger = setup_logger('main_logger', os.path.join(log_dir, 'main.log'))
-scraper_logger = setup_logger('scraper_logger', os.path.join(log_dir, 'scraper.log'))
-
-# Set logging levels
-main_logger.setLevel(logging.DEBUG)
-scraper_logger.setLevel(logging.DEBUG)
-
-# Add this line to make scraper_logger available globally
-globals()['scraper_logger'] = scraper_logger
+def configure_logging():
+    """Create the log directory and attach handlers once per process"""
+    if main_logger.handlers:
+        return
+    if not os.path.exists(log_dir):
+        os.makedirs(log_dir)
+    setup_logger('main_logger', os.path.join(log_dir, 'main.log'))
+    setup_logger('scraper_logger', os.path.join(log_dir, 'scraper.log'))
 
 # Add this function to check for write permissions
 def check_log_permissions(log_dir):
@@ -110,27 +146,20 @@ def test_logging():
 
 app = FastAPI()
 
-js_scroll_function = """
-function sleep(ms) {
-  return new Promise(resolve => setTimeout(resolve, ms));
-}
-
-async function scrollToEnd() {
-  let lastHeight = document.body.scrollHeight;
-  for (let i = 0; i < 15; i++) {
-    window.scrollTo(0, document.body.scrollHeight);
-    await sleep(3000);
-    if (document.body.scrollHeight === lastHeight) {
-      console.log("Reached the bottom or no more content to load.");
-      break;
-    }
-    lastHeight = document.body.scrollHeight;
-  }
-  console.log("Finished scrolling.");
-}
-
-scrollToEnd();
-"""
+# Polled constantly by orchestrators and monitoring; tracing them would only fill the trace directory
+UNTRACED_PATHS = ("/healthz", "/metrics")
+
+@app.middleware("http")
+async def trace_requests(request: Request, call_next):
+    if request.url.path in UNTRACED_PATHS:
+        return await call_next(request)
+    # Everything logged or traced while handling the request carries this id
+    with start_trace(f"{request.method} {request.url.path}",
+                     request_id=request.headers.get("x-request-id")) as info:
+        response = await call_next(request)
+        info["status"] = response.status_code
+    response.headers["X-Request-ID"] = info["request_id"]
+    return response
 
 def parse_channel(data):
     if "itemList" not in data:
@@ -140,36 +169,21 @@ def parse_channel(data):
     parsed_data = []
     for post in data["itemList"]:
         try:
-            result = {
-                "createTime": post.get("createTime"),
-                "desc": post.get("desc"),
-                "id": post.get("id"),
-                "stats": post.get("stats"),
-                "video": {
-                    "duration": post.get("video", {}).get("duration"),
-                    "ratio": post.get("video", {}).get("ratio"),
-                    "cover": post.get("video", {}).get("cover"),
-                    "playAddr": post.get("video", {}).get("playAddr"),
-                    "downloadAddr": post.get("video", {}).get("downloadAddr")
-                }
-            }
-            parsed_data.append(result)
+            parsed_data.append(parse_item(post))
         except Exception as e:
             scraper_logger.error(f"Error parsing post: {str(e)}")
     
     return parsed_data
 
 async def load_page_with_retry(page, url, max_attempts=3):
-    for attempt in range(1, max_attempts + 1):
-        try:
-            await page.goto(url, timeout=30000)
-            main_logger.info(f"Successfully loaded page: {url}")
-            return True
-        except Exception as e:
-            scraper_logger.warning(f"Error loading page. Retrying... Attempt {attempt}/{max_attempts}. Error: {str(e)}")
-            await asyncio.sleep(2)  # Wait before retrying
-    scraper_logger.error(f"Failed to load page after {max_attempts} attempts: {url}")
-    return False
+    try:
+        await async_call_with_retry([("goto", lambda: page.goto(url, timeout=30000))],
+                                    max_attempts=max_attempts, description=f"load {url}")
+        main_logger.info(f"Successfully loaded page: {url}")
+        return True
+    except ScrapeError as e:
+        scraper_logger.error(f"Failed to load page {url}: {str(e)}")
+        return False
 
 def parse_json_response(response_text):
     try:
@@ -254,18 +268,30 @@ def parse_api_response(response_json):
         "videos": item_list  # Directly assigning the raw itemList
     }
 
-async def intercept_xhr(page):
-    xhr_data_list = []
+async def intercept_xhr(page, proxy=None, capture=None):
+    """Route TikTok API calls through the rate limiter and forward each response to ``capture``"""
+    capture = capture if capture is not None else Capture()
+    # Route handlers run in Playwright's dispatcher tasks, not in the request's context
+    request_context = capture_context()
 
     async def handle_route(route, request):
         if "api/post/item_list" in request.url or "api/user/detail" in request.url:
+            with restore(request_context):
+                if await handle_xhr(route, request):
+                    return
+        await route.continue_()
+
+    async def handle_xhr(route, request):
+        endpoint = endpoint_for_url(request.url)
+        with span("xhr", endpoint=endpoint, url=request.url) as info:
             try:
                 main_logger.debug(f"Intercepting XHR request: {request.url}")
                 main_logger.debug(f"Request headers: {request.headers}")
                 main_logger.debug(f"Request method: {request.method}")
                 
-                # Add a random delay before fetching to avoid rate limiting
-                await asyncio.sleep(random.uniform(1, 3))
+                # Wait for the adaptive per-proxy / per-endpoint budget instead of a fixed random delay
+                with span("rate_limit_wait", endpoint=endpoint):
+                    await rate_limiter.acquire(proxy, endpoint)
                 
                 # Modify headers to mimic a real browser more closely
                 modified_headers = {
@@ -278,76 +304,106 @@ async def intercept_xhr(page):
                     "Referer": "https://www.tiktok.com/",
                 }
                 
-                response = await route.fetch(headers=modified_headers)
+                # Retry only this page of results, not the whole scrape
+                response = await async_call_with_retry(
+                    [("fetch", lambda: route.fetch(headers=modified_headers))],
+                    max_attempts=2, description=f"XHR {endpoint}")
                 response_body = await response.text()
+                info["status"] = response.status
+                info["bytes"] = len(response_body)
                 
                 main_logger.debug(f"Received XHR response with status: {response.status}")
                 main_logger.debug(f"Response headers: {response.headers}")
                 main_logger.debug(f"Response body (first 1000 chars): {response_body[:1000]}")
                 
-                if response_body:
+                outcome = rate_limiter.observe(proxy, endpoint, response.status, response_body)
+                if outcome == BLOCKED:
+                    scraper_logger.warning(f"Blocked response for {request.url}, not capturing it")
+                elif response_body:
                     try:
-                        json_data = json.loads(response_body)
-                        xhr_data = {
-                            "url": request.url,
-                            "method": request.method,
-                            "request_headers": dict(modified_headers),
-                            "response_status": response.status,
-                            "response_headers": dict(response.headers),
-                            "response_body": json_data
-                        }
-                        xhr_data_list.append(xhr_data)
-                        main_logger.info(f"Successfully captured XHR data for: {request.url}")
+                        # Holds back the page's next request while the sink catches up, for at most CAPTURE_SINK_TIMEOUT
+                        if await capture.offer(request.url, response.status, response_body):
+                            main_logger.info(f"Successfully captured XHR data for: {request.url}")
                     except json.JSONDecodeError:
                         main_logger.error(f"Failed to parse JSON from response: {response_body[:1000]}")
                 else:
                     main_logger.warning(f"Empty response body for URL: {request.url}")
+                # Hand the fetched response to the page rather than sending the request a second time
+                await route.fulfill(response=response, body=response_body)
+                return True
+            except BlockedError as e:
+                # Don't let the page send the request unthrottled while the identity cools down
+                scraper_logger.warning(f"Aborting XHR {request.url}: {e}")
+                await route.abort()
+                return True
             except Exception as e:
                 main_logger.error(f"Error intercepting XHR {request.url}: {str(e)}")
-        
-        await route.continue_()
+                return False
     
     await page.route("**/*", handle_route)
-    return xhr_data_list
+    return capture
+
+async def scrape_profile_playwright(username: str, sink=None):
+    """Scrape a profile's API responses with Playwright.
+
+    Pages go to ``sink`` as they arrive; without one they are collected and
+    returned as ``xhr_data``.
+    """
+    from playwright.async_api import async_playwright, Error as PlaywrightError, TimeoutError as PlaywrightTimeoutError
 
-async def scrape_profile_playwright(username: str):
     main_logger.info(f"Starting scrape_profile_playwright for username: {username}")
     async with async_playwright() as p:
-        browser = await p.chromium.launch(headless=True)
-        context = await browser.new_context(
-            user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
-        )
-        page = await context.new_page()
+        with span("browser_create"):
+            browser = await p.chromium.launch(headless=True)
+            # Start from the stored cookies so TikTok skips its first-visit verification
+            context = await browser.new_context(
+                user_agent="Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
+                storage_state=state_cache.get(None)
+            )
+            page = await context.new_page()
 
         page.on("console", lambda msg: scraper_logger.debug(f"Browser console: {msg.text}"))
 
         main_logger.info(f"Starting XHR interception for username: {username}")
-        xhr_data_list = await intercept_xhr(page)
-
-        url = f"https://www.tiktok.com/@{username}"
-        main_logger.info(f"Attempting to navigate to: {url}")
+        collected = ListSink() if sink is None else sink
+        capture = await intercept_xhr(page, capture=Capture(StatsSink(get_stats_store(), collected)))
 
         try:
-            await page.goto(url, wait_until="networkidle", timeout=60000)
-            main_logger.info(f"Successfully loaded page: {url}")
-        except PlaywrightTimeoutError:
-            main_logger.warning(f"Timeout while loading page: {url}. Continuing with partial page load.")
+            url = f"https://www.tiktok.com/@{username}"
+            main_logger.info(f"Attempting to navigate to: {url}")
 
-        try:
-            main_logger.info("Starting scroll function")
-            await page.evaluate(js_scroll_function)
-            main_logger.info(f"Finished scrolling for username: {username}")
-        except PlaywrightError as e:
-            main_logger.error(f"Error during scrolling for username {username}: {str(e)}")
-
-        main_logger.info("Waiting for additional XHR requests")
-        await page.wait_for_timeout(10000)
-
-        await browser.close()
+            try:
+                with span("navigate", url=url):
+                    await page.goto(url, wait_until="networkidle", timeout=60000)
+                main_logger.info(f"Successfully loaded page: {url}")
+            except PlaywrightTimeoutError:
+                main_logger.warning(f"Timeout while loading page: {url}. Continuing with partial page load.")
 
-    if xhr_data_list:
-        main_logger.info(f"Captured {len(xhr_data_list)} XHR requests for username: {username}")
-        return {"xhr_data": xhr_data_list}
+            scroll_engine = ScrollEngine(page, should_stop=capture.exhausted)
+            try:
+                main_logger.info("Starting scroll engine")
+                with span("scroll") as info:
+                    info.update(await scroll_engine.run())
+                main_logger.info(f"Finished scrolling for username: {username}")
+            except PlaywrightError as e:
+                main_logger.error(f"Error during scrolling for username {username}: {str(e)}")
+
+            main_logger.info("Waiting for additional XHR requests")
+            with span("settle"):
+                await scroll_engine.settle()
+
+            state_cache.save(None, await context.storage_state())
+            await browser.close()
+        finally:
+            # Lets the sink flush or finish even if the scrape failed
+            await capture.close()
+
+    if capture.pages:
+        main_logger.info(f"Captured {capture.pages} XHR requests ({capture.captured_bytes} bytes) "
+                         f"for username: {username}")
+        if sink is None:
+            return {"xhr_data": collected.pages, "capture": capture.summary()}
+        return {"capture": capture.summary()}
     else:
         main_logger.warning(f"No XHR data captured for username: {username}")
         return {"error": f"No XHR data captured for username: {username}"}
@@ -417,8 +473,9 @@ def verify_proxy_executable():
     return True
 
 def check_network_connectivity():
+    # The host every scrape needs, not a generic probe that may be filtered differently
     try:
-        socket.create_connection(("www.google.com", 80))
+        socket.create_connection(("www.tiktok.com", 443), timeout=5).close()
         main_logger.info("Network connectivity: OK")
         return True
     except OSError:
@@ -426,11 +483,15 @@ def check_network_connectivity():
         return False
 
 def monitor_resource_usage():
+    import psutil
+
     cpu_percent = psutil.cpu_percent()
     memory_percent = psutil.virtual_memory().percent
     main_logger.info(f"CPU usage: {cpu_percent}%, Memory usage: {memory_percent}%")
 
 def setup_proxy():
+    from browsermobproxy import Server
+
     if not verify_java_installation():
         return None, None
 
@@ -452,7 +513,7 @@ def setup_proxy():
             time.sleep(2)
             
             try:
-                proxy = server.create_proxy()
+                proxy = create_browsermob_proxy(server)
                 main_logger.info(f"Proxy created successfully on port {proxy.port}")
                 return server, proxy
             except Exception as e:
@@ -473,6 +534,11 @@ def setup_proxy():
     return None, None
 
 def initialize_driver(proxy):
+    from selenium import webdriver
+    from selenium.webdriver.chrome.service import Service
+    from selenium.webdriver.chrome.options import Options
+    from selenium.webdriver.common.proxy import Proxy, ProxyType
+
     chrome_options = Options()
     chrome_options.add_argument("--headless")
     chrome_options.add_argument("--disable-gpu")
@@ -504,7 +570,23 @@ def initialize_driver(proxy):
     driver = webdriver.Chrome(service=service, options=chrome_options)
     return driver
 
+def create_browsermob_proxy(server):
+    """Create a BrowserMob listener tagged with the upstream it egresses through.
+
+    The rate limiter and browser state key on ``proxy.upstream`` (see
+    proxy_key), since the local listener port says nothing about the address
+    TikTok sees.
+    """
+    params = {"httpProxy": BROWSERMOB_UPSTREAM_PROXY} if BROWSERMOB_UPSTREAM_PROXY else None
+    proxy = server.create_proxy(params=params)
+    proxy.upstream = BROWSERMOB_UPSTREAM_PROXY or None
+    return proxy
+
+@traced("proxy_setup")
 def setup_browsermob_proxy():
+    import requests
+    from browsermobproxy import Server
+
     try:
         proxy_path = os.environ.get('BROWSERMOB_PROXY_PATH', '/opt/browsermob-proxy/bin/browsermob-proxy')
         port = int(os.environ.get('PORT', 10000))
@@ -524,7 +606,7 @@ def setup_browsermob_proxy():
         server.start()
         main_logger.info(f"Browsermob-Proxy server started on port {port}")
         
-        proxy = server.create_proxy()
+        proxy = create_browsermob_proxy(server)
         main_logger.info(f"Proxy instance created on port {proxy.port}")
         
         # Test proxy connection
@@ -542,11 +624,13 @@ def setup_browsermob_proxy():
         return None, None
 
 def create_proxy():
+    import requests
+
     try:
         proxy = requests.post(f'http://{PROXY_HOST}:{PROXY_PORT}/proxy').json()
         return proxy['port']
     except requests.RequestException as e:
-        logger.error(f"Failed to create proxy: {e}")
+        main_logger.error(f"Failed to create proxy: {e}")
         raise
 
 def gather_xhr_with_browsermob(proxy, url):
@@ -559,6 +643,7 @@ def gather_xhr_with_browsermob(proxy, url):
         driver = setup_selenium_with_proxy(proxy)
         
         try:
+            rate_limiter.acquire_sync(proxy, "profile")
             main_logger.info(f"Sending GET request to {url}")
             driver.get(url)
             # Add code here to extract XHR data
@@ -569,14 +654,24 @@ def gather_xhr_with_browsermob(proxy, url):
             main_logger.info(f"Closed WebDriver")
         
         return xhr_data, success
+    except BlockedError:
+        raise
     except Exception as e:
         main_logger.error(f"Error in gather_xhr_with_browsermob: {e}")
         return None, False
 
-def gather_xhr_with_selenium(driver, url, timeout=30):
+def gather_xhr_with_selenium(driver, url, timeout=30, proxy=None):
+    from selenium.webdriver.common.by import By
+    from selenium.webdriver.support.ui import WebDriverWait
+    from selenium.webdriver.support import expected_conditions as EC
+    from selenium.common.exceptions import TimeoutException
+
     try:
+        rate_limiter.acquire_sync(proxy, "profile")
         main_logger.info(f"Navigating to {url} with Selenium")
-        driver.get(url)
+        with span("navigate", url=url, engine="selenium"):
+            driver.get(url)
+        # The page itself is classified once, by check_profile_html
         
         # Wait for the body element to be present
         WebDriverWait(driver, timeout).until(EC.presence_of_element_located((By.TAG_NAME, "body")))
@@ -587,7 +682,8 @@ def gather_xhr_with_selenium(driver, url, timeout=30):
         driver.set_script_timeout(timeout)
         
         # Execute JavaScript to capture XHR with a timeout
-        xhr_data = driver.execute_async_script("""
+        with span("xhr_capture", engine="selenium") as info:
+            xhr_data = driver.execute_async_script("""
             var callback = arguments[arguments.length - 1];
             var xhrData = [];
             var open = XMLHttpRequest.prototype.open;
@@ -607,9 +703,16 @@ def gather_xhr_with_selenium(driver, url, timeout=30):
                 callback(xhrData);
             }, 10000);  // Wait for 10 seconds
         """)
+            info["requests"] = len(xhr_data)
         
         main_logger.info(f"Captured {len(xhr_data)} XHR requests")
+        for entry in xhr_data:
+            entry_url = entry.get('url') or ''
+            if "api/post/item_list" in entry_url or "api/user/detail" in entry_url:
+                rate_limiter.observe(proxy, endpoint_for_url(entry_url), 200, entry.get('data'))
         return xhr_data
+    except BlockedError:
+        raise
     except TimeoutException:
         main_logger.error(f"Timeout while loading page or executing script: {url}")
         return None
@@ -617,7 +720,12 @@ def gather_xhr_with_selenium(driver, url, timeout=30):
         main_logger.error(f"Error gathering XHR with Selenium: {e}")
         return None
 
+@traced("driver_create")
 def setup_selenium_with_proxy(proxy):
+    from selenium import webdriver
+    from selenium.webdriver.chrome.service import Service
+    from selenium.webdriver.chrome.options import Options
+
     options = Options()
     if proxy:
         options.add_argument(f'--proxy-server={proxy.proxy}')
@@ -671,35 +779,6 @@ def setup_and_scrape(username):
             except Exception as e:
                 main_logger.error(f"Error closing proxy: {e}")
 
-@retry(stop=stop_after_attempt(3), 
-       wait=wait_exponential(multiplier=1, min=4, max=10),
-       retry=retry_if_exception_type((requests.RequestException, WebDriverException, Exception)))
-async def scrape_tiktok(request: ScrapeRequest):
-    main_logger.info(f"Received scrape request for username: {request.username}")
-    
-    # Check if there's a saved state for this username
-    saved_state = load_scraping_state(request.username)
-    
-    try:
-        if saved_state:
-            main_logger.info(f"Resuming scraping for {request.username} from saved state")
-            result = resume_scraping(request.username, saved_state)
-        else:
-            result = setup_and_scrape(request.username)
-        
-        if result:
-            main_logger.info(f"Successfully scraped data for username: {request.username}")
-            # Clear the saved state after successful scraping
-            clear_scraping_state(request.username)
-            return result
-        else:
-            raise HTTPException(status_code=500, detail="Failed to scrape TikTok profile")
-    except Exception as e:
-        main_logger.error(f"Error during scraping: {str(e)}")
-        # Save the current state before raising the exception
-        save_scraping_state(request.username, get_current_state())
-        raise HTTPException(status_code=500, detail=f"Error during scraping: {str(e)}")
-
 def load_scraping_state(username):
     # Implement logic to load saved state from a file or database
     # Return None if no saved state exists
@@ -721,62 +800,99 @@ def resume_scraping(username, saved_state):
     # Implement logic to resume scraping from the saved state
     pass
 
-@retry(stop=stop_after_attempt(2), 
-       wait=wait_exponential(multiplier=1, min=4, max=10),
-       retry=retry_if_exception_type((requests.RequestException, WebDriverException, Exception)))
-def scrape_tiktok_profile(username, server, proxy):
-    driver = None
+PROFILE_NOT_FOUND_MARKERS = ("Couldn't find this account", '"statusCode":10221')
+
+def check_profile_html(html, proxy=None):
+    """Raise a classified error if the profile page is missing or a challenge page"""
+    if not html:
+        raise TransientNetworkError("Empty profile page")
+    if any(marker in html for marker in PROFILE_NOT_FOUND_MARKERS):
+        raise NotFoundError("TikTok account not found")
+    if rate_limiter.observe(proxy, "profile", 200, html) == BLOCKED:
+        raise BlockedError("TikTok served a challenge page")
+
+def scrape_with_browsermob(url, proxy):
+    import requests
+
+    if rate_limiter.is_flagged(proxy):
+        raise BlockedError(f"Proxy {proxy_key(proxy)} is flagged as blocked")
+    main_logger.info(f"Attempting to gather XHR with Browsermob for {url}")
+    xhr_data, success = gather_xhr_with_browsermob(proxy, url)
+    if not success:
+        raise InfraError("Failed to gather XHR data with Browsermob")
+
+    main_logger.info("Capturing page source")
+    proxy_config = setup_proxy_config(proxy)
+    rate_limiter.acquire_sync(proxy, "profile")
+    with span("navigate", url=url, engine="requests") as info:
+        response = requests.get(url, proxies=proxy_config, timeout=30)
+        info["status"] = response.status_code
+    if response.status_code == 404:
+        raise NotFoundError("TikTok account not found")
+    check_profile_html(response.text, proxy)
+    return response.text, xhr_data
+
+def apply_browser_state(driver, state):
+    """Load stored cookies into a fresh Selenium session before the real navigation"""
+    if not state:
+        return
+    # Selenium only accepts cookies for the domain of the current page
+    driver.get("https://www.tiktok.com/robots.txt")
+    for cookie in cookies_for_selenium(state):
+        try:
+            driver.add_cookie(cookie)
+        except Exception as e:
+            main_logger.debug(f"Could not restore cookie {cookie['name']}: {e}")
+    main_logger.info("Restored stored browser state into Selenium session")
+
+def scrape_with_selenium(url, proxy):
+    # Don't route through a proxy that has just been flagged
+    if proxy and rate_limiter.is_flagged(proxy):
+        proxy = None
+    main_logger.info(f"Attempting with Selenium ({'proxied' if proxy else 'direct'})")
+    driver = setup_selenium_with_proxy(proxy)
+    # Cookies belong to the address TikTok sees: the BrowserMob upstream, not the local listener,
+    # which is also the identity the rate limiter throttles and flags
+    identity = proxy_key(proxy)
     try:
-        url = f"https://www.tiktok.com/@{username}"
-        
-        if proxy:
-            main_logger.info(f"Attempting to gather XHR with Browsermob for {username}")
-            xhr_data, success = gather_xhr_with_browsermob(proxy, url)
-        else:
-            success = False
-            main_logger.warning("Browsermob-Proxy not available, falling back to Selenium")
-
-        if not success:
-            main_logger.info("Attempting with Selenium")
-            try:
-                driver = setup_selenium_with_proxy(proxy) if proxy else setup_selenium_with_proxy(None)
-                xhr_data = gather_xhr_with_selenium(driver, url)
-                if xhr_data is None:
-                    main_logger.warning("Failed to gather XHR data with Selenium")
-                    success = False
-                else:
-                    success = True
-            except Exception as e:
-                main_logger.error(f"Error setting up or using Selenium: {e}")
-                success = False
+        apply_browser_state(driver, state_cache.get(identity))
+        xhr_data = gather_xhr_with_selenium(driver, url, proxy=proxy)
+        if xhr_data is None:
+            raise TransientNetworkError("Failed to gather XHR data with Selenium")
+        main_logger.info("Capturing page source")
+        html_content = driver.page_source
+        state_cache.save(identity, {"cookies": cookies_from_selenium(driver.get_cookies()), "origins": []})
+    finally:
+        main_logger.info("Closing Selenium WebDriver")
+        driver.quit()
+    check_profile_html(html_content, proxy)
+    return html_content, xhr_data
 
-        if not success:
-            main_logger.error("Failed to gather XHR data with both Browsermob and Selenium")
-            return None
+def scrape_tiktok_profile(username, server, proxy):
+    url = f"https://www.tiktok.com/@{username}"
 
-        main_logger.info("Capturing page source")
-        if driver:
-            html_content = driver.page_source
-        else:
-            proxy_config = setup_proxy_config(proxy)
-            response = requests.get(url, proxies=proxy_config)
-            html_content = response.text
+    # Each retry moves to the next engine / proxy combination instead of repeating the one that failed
+    strategies = []
+    if proxy:
+        strategies.append(("browsermob", lambda: scrape_with_browsermob(url, proxy)))
+        strategies.append(("selenium-proxy", lambda: scrape_with_selenium(url, proxy)))
+    else:
+        main_logger.warning("Browsermob-Proxy not available, falling back to Selenium")
+    strategies.append(("selenium-direct", lambda: scrape_with_selenium(url, None)))
 
-        main_logger.info("Parsing profile HTML")
-        profile_data = parse_profile_html(html_content)
-        
-        profile_data['xhr_data'] = xhr_data
-        
-        main_logger.info(f"Scraping completed for {username}")
-        return profile_data
-    except Exception as e:
-        main_logger.error(f"Error scraping profile: {e}")
-        main_logger.exception("Full traceback:")
+    try:
+        html_content, xhr_data = call_with_retry(strategies, description=f"scrape {username}")
+    except ScrapeError as e:
+        main_logger.error(f"Error scraping profile {username} ({e.kind}): {e}")
         raise
-    finally:
-        if driver:
-            main_logger.info("Closing Selenium WebDriver")
-            driver.quit()
+
+    main_logger.info("Parsing profile HTML")
+    profile_data = parse_profile_html(html_content)
+    
+    profile_data['xhr_data'] = xhr_data
+    
+    main_logger.info(f"Scraping completed for {username}")
+    return profile_data
 
 def extract_xhr_data(har_data):
     xhr_entries = [entry for entry in har_data['log']['entries'] 
@@ -805,7 +921,10 @@ def extract_xhr_data(har_data):
     main_logger.info(f"Processed {len(processed_xhr_data)} XHR entries")
     return processed_xhr_data
 
+@traced()
 def parse_profile_html(html):
+    from bs4 import BeautifulSoup
+
     soup = BeautifulSoup(html, 'html.parser')
     profile_data = {}
     
@@ -848,6 +967,15 @@ def parse_profile_html(html):
     
     return profile_data
 
+def preload_engines():
+    """Import the browser engines ahead of the first scrape"""
+    import playwright.async_api  # noqa: F401
+    import selenium.webdriver  # noqa: F401
+    import browsermobproxy  # noqa: F401
+    import bs4  # noqa: F401
+    import requests  # noqa: F401
+    return True
+
 def perform_setup_verification():
     main_logger.info("Performing setup verification...")
     if not verify_java_installation():
@@ -860,21 +988,263 @@ def perform_setup_verification():
     main_logger.info("Setup verification completed successfully")
     return True
 
+async def run_scrape(username):
+    if SCRAPE_POOL_MODE == 'process':
+        # The worker writes the encoded result into shared memory and records its stats;
+        # each coalesced request streams the segment (see SharedResultResponse)
+        with span("worker_pool", username=username):
+            return await worker_pool.submit(username)
+    loop = asyncio.get_running_loop()
+    # bind() carries the request id and trace into the executor thread
+    with span("scrape", username=username):
+        return await loop.run_in_executor(None, bind(setup_and_scrape, username))
+
+# Scheduler jobs of in-flight scrapes by coalescing key, so later callers can promote them
+scheduled_jobs = {}
+
+def start_scheduled_scrape(key, username, client_id, priority):
+    # Queued synchronously, before scrape_flight starts the task, so callers attaching
+    # right behind this one already find the job to promote
+    job = scrape_scheduler.submit(client_id, priority)
+    scheduled_jobs[key] = job
+    return run_scheduled_scrape(key, job, username)
+
+def posts_from_xhr_data(xhr_data):
+    """Parsed posts of the item_list pages in a scrape's ``xhr_data``"""
+    posts = []
+    for entry in xhr_data or []:
+        if "api/post/item_list" not in (entry.get('url') or ''):
+            continue
+        if 'response_body' in entry:
+            # Playwright captures are already reduced to parse_item results
+            posts.extend(entry['response_body'].get('itemList') or [])
+            continue
+        data = entry.get('data')
+        if isinstance(data, str):
+            try:
+                data = json.loads(data)
+            except json.JSONDecodeError:
+                continue
+        if isinstance(data, dict):
+            posts.extend(parse_channel(data))
+    return posts
+
+def record_scrape_stats(result):
+    """Feed the posts of a scrape result into the stats store; not for the event loop thread"""
+    return get_stats_store().record_posts(posts_from_xhr_data(result.get('xhr_data')))
+
+async def run_scheduled_scrape(key, job, username):
+    try:
+        with span("queue_wait", priority=job.priority, client_id=job.client_id):
+            wait = await scrape_scheduler.wait(job)
+        main_logger.info(f"Starting {job.priority} scrape of {username} for {job.client_id} "
+                         f"after {wait:.2f}s in queue")
+        try:
+            result = await run_scrape(username)
+        finally:
+            scrape_scheduler.release(job)
+    finally:
+        scheduled_jobs.pop(key, None)
+    if not isinstance(result, dict):
+        # Process mode: the worker already recorded the stats
+        return result
+    try:
+        with span("record_stats"):
+            changed = await asyncio.get_running_loop().run_in_executor(None, bind(record_scrape_stats, result))
+        main_logger.debug(f"Recorded stats changes for {changed} posts of {username}")
+    except Exception as e:
+        # The scrape itself succeeded; losing one stats sample must not fail it
+        main_logger.error(f"Could not record stats for {username}: {str(e)}")
+    return result
+
+class SharedResultResponse(StreamingResponse):
+    """Stream a process-mode result and release this response's reference however it ends"""
+
+    def __init__(self, result):
+        super().__init__(result.iter_chunks(), media_type="application/json")
+        self.result = result
+
+    async def __call__(self, scope, receive, send):
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.result.release()
+
 @app.post("/scrape")
 async def scrape_tiktok(request: ScrapeRequest):
-    main_logger.info(f"Received scrape request for username: {request.username}")
+    main_logger.info(f"Received {request.priority} scrape request from {request.client_id} "
+                     f"for username: {request.username}")
+    if request.priority not in PRIORITY_CLASSES:
+        raise HTTPException(status_code=400, detail=f"priority must be one of {', '.join(PRIORITY_CLASSES)}")
     
+    # Identical concurrent requests share one scrape instead of each launching a browser;
+    # who asked and at what priority doesn't change the result
+    options = request.dict(exclude={'username', 'client_id', 'priority'})
+    key = request_key(request.username.strip().lstrip('@').lower(), **options)
+    job = scheduled_jobs.get(key)
+    if job is not None:
+        # A more urgent caller must not wait behind the queue the shared scrape was submitted to
+        scrape_scheduler.promote(job, request.client_id, request.priority)
     try:
-        result = setup_and_scrape(request.username)
-        if result:
-            main_logger.info(f"Successfully scraped data for username: {request.username}")
-            return result
-        else:
-            raise HTTPException(status_code=500, detail="Failed to scrape TikTok profile")
+        result = await scrape_flight.do(
+            key, lambda: start_scheduled_scrape(key, request.username, request.client_id, request.priority))
+    except QueueFullError as e:
+        raise HTTPException(status_code=429, detail=str(e))
+    except NotFoundError as e:
+        raise HTTPException(status_code=404, detail=f"User not found: {request.username}")
+    except BlockedError as e:
+        main_logger.error(f"Blocked while scraping {request.username}: {str(e)}")
+        raise HTTPException(status_code=503, detail=f"Blocked by TikTok: {str(e)}")
     except Exception as e:
         main_logger.error(f"Error during scraping: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error during scraping: {str(e)}")
 
+    if result:
+        main_logger.info(f"Successfully scraped data for username: {request.username}")
+        if isinstance(result, SharedResult):
+            return SharedResultResponse(result)
+        return result
+    raise HTTPException(status_code=500, detail="Failed to scrape TikTok profile")
+
+@app.on_event("startup")
+def start_readiness_probe():
+    configure_logging()
+    # Setup checks and engine imports run off the request path; /healthz reports progress
+    readiness_probe.add_check("java", verify_java_installation, required=False)
+    readiness_probe.add_check("browsermob_proxy", verify_proxy_executable, required=False)
+    readiness_probe.add_check("network", check_network_connectivity)
+    readiness_probe.add_check("engines", preload_engines)
+    readiness_probe.add_check("resources", monitor_resource_usage, required=False)
+    readiness_probe.start()
+
+@app.get("/healthz")
+def healthz():
+    report = readiness_probe.report()
+    if report["status"] in ("ready", "degraded"):
+        return report
+    return JSONResponse(status_code=503, content=report)
+
+@app.on_event("startup")
+async def start_browser_state_refresh():
+    if STATE_REFRESH_INTERVAL > 0:
+        app.state.browser_state_refresh = asyncio.create_task(state_cache.refresh_loop())
+
+@app.on_event("startup")
+def start_cluster_worker():
+    if CLUSTER_ROLE == 'worker':
+        from cluster_worker import ClusterWorker
+        app.state.cluster_worker = ClusterWorker()
+        app.state.cluster_worker.start()
+        main_logger.info("Started cluster worker loop")
+
+@app.on_event("shutdown")
+def shutdown_worker_pool():
+    worker_pool.shutdown()
+    if CLUSTER_ROLE == 'worker':
+        app.state.cluster_worker.stop()
+    if stats_store_loaded():
+        get_stats_store().compact()
+
+def require_coordinator():
+    if CLUSTER_ROLE != 'coordinator':
+        raise HTTPException(status_code=404, detail="This node is not running as cluster coordinator")
+
+@app.post("/cluster/jobs")
+def submit_cluster_jobs(request: ClusterJobsRequest):
+    require_coordinator()
+    return {"jobs": [coordinator.submit(username).to_dict() for username in request.usernames]}
+
+@app.get("/cluster/jobs/{job_id}")
+def get_cluster_job(job_id: str):
+    require_coordinator()
+    job = coordinator.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job: {job_id}")
+    return job.to_dict(include_result=True)
+
+@app.post("/cluster/workers")
+def register_cluster_worker(request: RegisterWorkerRequest):
+    require_coordinator()
+    coordinator.register(request.worker_id, request.url, request.capacity)
+    return {"registered": request.worker_id}
+
+@app.post("/cluster/heartbeat")
+def cluster_heartbeat(request: HeartbeatRequest):
+    require_coordinator()
+    return {"known": coordinator.heartbeat(request.worker_id, request.free_capacity, request.job_ids)}
+
+@app.post("/cluster/lease")
+def lease_cluster_jobs(request: LeaseRequest):
+    require_coordinator()
+    jobs = coordinator.lease(request.worker_id, request.free_capacity)
+    if jobs is None:
+        raise HTTPException(status_code=409, detail=f"Worker not registered: {request.worker_id}")
+    return {"jobs": [job.to_dict() for job in jobs]}
+
+@app.post("/cluster/complete")
+def complete_cluster_job(request: CompleteJobRequest):
+    require_coordinator()
+    return {"accepted": coordinator.complete(request.worker_id, request.job_id, request.result, request.error)}
+
+@app.get("/cluster/status")
+def cluster_status():
+    require_coordinator()
+    coordinator.reap()
+    return coordinator.status()
+
+@app.post("/posts")
+async def scrape_posts_bulk(request: PostsRequest):
+    main_logger.info(f"Received posts request for {len(request.ids)} videos")
+    if len(request.ids) > MAX_POSTS_PER_REQUEST:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_POSTS_PER_REQUEST} videos per request")
+    result = await scrape_posts(request.ids, browser_fallback=request.browser_fallback)
+    main_logger.info(f"Scraped {len(result['posts'])} posts, {len(result['errors'])} errors")
+    # Compaction rewrites the whole snapshot, so it must not run on the event loop
+    changed = await asyncio.get_running_loop().run_in_executor(
+        None, lambda: get_stats_store().record_posts(result['posts']))
+    main_logger.debug(f"Recorded stats changes for {changed} posts")
+    return result
+
+@app.post("/media")
+def download_media(request: MediaRequest):
+    urls = request.urls + media_urls_from_posts(request.posts, request.fields)
+    rejected = [url for url in urls if not is_allowed_media_url(url)]
+    if rejected:
+        raise HTTPException(status_code=400, detail=f"Only TikTok CDN URLs can be downloaded: {rejected[:5]}")
+    main_logger.info(f"Received media request for {len(urls)} URLs")
+    store = get_media_store()
+    return {"media": store.download_many(urls), "usage": store.usage()}
+
+@app.get("/media/{sha256}")
+def get_media(sha256: str):
+    if not is_sha256(sha256):
+        raise HTTPException(status_code=404, detail=f"Unknown media object: {sha256}")
+    path = get_media_store().object_path(sha256)
+    if not os.path.exists(path):
+        raise HTTPException(status_code=404, detail=f"Unknown media object: {sha256}")
+    return FileResponse(path)
+
+@app.get("/stats/creator/{creator}")
+def creator_stats(creator: str):
+    return {"creator": creator, "videos": get_stats_store().videos_for_creator(creator.lstrip('@'))}
+
+@app.get("/stats/{video_id}")
+def video_stats(video_id: str, start: Optional[float] = None, end: Optional[float] = None):
+    series = get_stats_store().query(video_id, start=start, end=end)
+    if series is None:
+        raise HTTPException(status_code=404, detail=f"No stats recorded for video: {video_id}")
+    return series
+
+@app.get("/metrics")
+async def metrics():
+    # Runs on the event loop, where the scheduler state lives
+    return {
+        "scheduler": scrape_scheduler.metrics(),
+        "in_flight_scrapes": scrape_flight.in_flight(),
+        "retry_budget": retry_budget.snapshot(),
+        "rate_limiter": rate_limiter.snapshot(),
+    }
+
 @app.get("/")
 async def root():
     return {"message": "TikTok Scraper API is running. Use POST /scrape to scrape data."}
@@ -886,6 +1256,7 @@ def check_proxy_settings(proxy):
     main_logger.info(f"Proxy har: {proxy.har}")
 
 if __name__ == "__main__":
+    configure_logging()
     app_port = int(os.environ.get('PORT', '10000'))
     main_logger.info(f"Starting application on port {app_port}")
     
@@ -0,0 +1,290 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl, urlencode, urljoin, urlsplit
+
+from retry_policy import call_with_retry, classify_exception, NotFoundError, TransientNetworkError
+from scraper import get_http_session
+
+logger = logging.getLogger('scraper_logger')
+
+MEDIA_STORE_DIR = os.environ.get('MEDIA_STORE_DIR', 'media_store')
+MEDIA_DISK_BUDGET = int(os.environ.get('MEDIA_DISK_BUDGET', str(10 * 1024 ** 3)))  # bytes
+MEDIA_CONCURRENCY = int(os.environ.get('MEDIA_CONCURRENCY', '16'))
+MEDIA_PER_HOST_CONCURRENCY = int(os.environ.get('MEDIA_PER_HOST_CONCURRENCY', '4'))
+MEDIA_CHUNK_SIZE = 256 * 1024
+# Seconds between index.json writes; download_many always writes once at the end
+MEDIA_INDEX_SAVE_INTERVAL = float(os.environ.get('MEDIA_INDEX_SAVE_INTERVAL', '5'))
+
+MEDIA_FIELDS = ("cover", "playAddr", "downloadAddr")
+# Only TikTok's own CDNs are fetched; anything else would make /media an open proxy
+MEDIA_ALLOWED_HOSTS = tuple(os.environ.get(
+    'MEDIA_ALLOWED_HOSTS',
+    'tiktokcdn.com,tiktokcdn-us.com,tiktokcdn-eu.com,tiktokv.com,tiktokv.us,tiktokv.eu,tiktok.com,'
+    'ibytedtos.com,byteoversea.com,muscdn.com').split(','))
+MEDIA_MAX_REDIRECTS = 3
+SHA256_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+# Query parameters TikTok rotates on every signed CDN URL; the rest (e.g. video_id) identify the object
+MEDIA_VOLATILE_PARAMS = frozenset(os.environ.get(
+    'MEDIA_VOLATILE_PARAMS', 'x-expires,x-signature,expire,expires,signature,policy,l').split(','))
+
+
+def media_key(url):
+    """Identity of a media URL that survives TikTok's rotating signature query strings"""
+    parts = urlsplit(url)
+    if not parts.path or parts.path == "/":
+        return url
+    query = sorted((name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True)
+                   if name.lower() not in MEDIA_VOLATILE_PARAMS)
+    return f"{parts.path}?{urlencode(query)}" if query else parts.path
+
+
+def is_allowed_media_url(url):
+    parts = urlsplit(url)
+    host = (parts.hostname or "").lower()
+    return parts.scheme in ("http", "https") and any(
+        host == allowed or host.endswith("." + allowed) for allowed in MEDIA_ALLOWED_HOSTS)
+
+
+def is_sha256(value):
+    return bool(SHA256_PATTERN.match(value))
+
+
+def media_urls_from_posts(posts, fields=MEDIA_FIELDS):
+    """Collect media URLs from parse_item / parse_channel results"""
+    urls = []
+    for post in posts:
+        video = post.get("video") or {}
+        for field in fields:
+            if video.get(field):
+                urls.append(video[field])
+    return urls
+
+
+class MediaStore:
+    """Content-addressed media cache with resumable downloads and an LRU disk budget.
+
+    Objects live under ``objects/<sha256[:2]>/<sha256>``; ``index.json`` maps URL
+    keys to hashes and records each object's size and last access so the least
+    recently used objects are evicted first once the budget is exceeded. The
+    index is written at most every MEDIA_INDEX_SAVE_INTERVAL seconds and at the
+    end of each download_many batch.
+    """
+
+    def __init__(self, root=MEDIA_STORE_DIR, budget=MEDIA_DISK_BUDGET, per_host=MEDIA_PER_HOST_CONCURRENCY):
+        self.root = root
+        self.budget = budget
+        self.per_host = per_host
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+        self._host_slots = {}
+        self._key_locks = {}
+        self._index_path = os.path.join(root, "index.json")
+        os.makedirs(os.path.join(root, "objects"), exist_ok=True)
+        os.makedirs(os.path.join(root, "partial"), exist_ok=True)
+        self._index = self._load_index()
+        self._used = sum(entry["size"] for entry in self._index["objects"].values())
+        self._dirty = False
+        self._saved_at = time.monotonic()
+
+    def _load_index(self):
+        try:
+            with open(self._index_path) as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {"urls": {}, "objects": {}}
+
+    def flush(self):
+        """Write index.json if anything changed since the last write"""
+        with self._lock:
+            if not self._dirty:
+                return
+            # Serialized under the lock, written outside it so downloads keep going meanwhile
+            data = json.dumps(self._index)
+            self._dirty = False
+            self._saved_at = time.monotonic()
+        with self._save_lock:
+            tmp_path = self._index_path + ".tmp"
+            with open(tmp_path, "w") as f:
+                f.write(data)
+            os.replace(tmp_path, self._index_path)
+
+    def _flush_if_due(self):
+        with self._lock:
+            due = self._dirty and time.monotonic() - self._saved_at >= MEDIA_INDEX_SAVE_INTERVAL
+        if due:
+            self.flush()
+
+    def object_path(self, sha256):
+        return os.path.join(self.root, "objects", sha256[:2], sha256)
+
+    def _partial_path(self, key):
+        return os.path.join(self.root, "partial", hashlib.sha1(key.encode()).hexdigest() + ".part")
+
+    def _host_slot(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.Semaphore(self.per_host)
+            return self._host_slots[host]
+
+    def _key_lock(self, key):
+        with self._lock:
+            if key not in self._key_locks:
+                self._key_locks[key] = threading.Lock()
+            return self._key_locks[key]
+
+    def lookup(self, url):
+        """Return the stored object for a URL and mark it recently used, or None"""
+        with self._lock:
+            sha256 = self._index["urls"].get(media_key(url))
+            entry = self._index["objects"].get(sha256) if sha256 else None
+            if entry is None or not os.path.exists(self.object_path(sha256)):
+                return None
+            entry["last_access"] = time.time()
+            self._dirty = True
+            return {"sha256": sha256, "size": entry["size"], "path": self.object_path(sha256)}
+
+    def _open(self, url, headers):
+        """GET ``url``, following redirects only while they stay on allowed hosts"""
+        for _ in range(MEDIA_MAX_REDIRECTS + 1):
+            response = get_http_session().get(url, headers=headers, stream=True, timeout=30, allow_redirects=False)
+            if not response.is_redirect:
+                return response
+            response.close()
+            url = urljoin(url, response.headers["Location"])
+            if not is_allowed_media_url(url):
+                raise NotFoundError(f"Media redirected to a host outside the allowlist: {url}")
+        raise TransientNetworkError(f"Too many redirects for media: {url}")
+
+    def _stream_to_partial(self, url, partial_path):
+        """Download into the partial file, resuming from its current length; returns its sha256"""
+        offset = os.path.getsize(partial_path) if os.path.exists(partial_path) else 0
+        headers = {"Referer": "https://www.tiktok.com/"}
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+
+        digest = hashlib.sha256()
+        with self._open(url, headers) as response:
+            if response.status_code in (403, 404, 410):
+                raise NotFoundError(f"Media unavailable ({response.status_code}): {url}")
+            if response.status_code == 416:
+                # The partial file is already complete
+                response.close()
+            elif response.status_code == 206 and offset:
+                logger.debug(f"Resuming {url} at byte {offset}")
+            else:
+                response.raise_for_status()
+                offset = 0
+
+            mode = "ab" if offset else "wb"
+            if offset:
+                with open(partial_path, "rb") as existing:
+                    for chunk in iter(lambda: existing.read(MEDIA_CHUNK_SIZE), b""):
+                        digest.update(chunk)
+            if response.status_code != 416:
+                with open(partial_path, mode) as f:
+                    for chunk in response.iter_content(chunk_size=MEDIA_CHUNK_SIZE):
+                        f.write(chunk)
+                        digest.update(chunk)
+        if not os.path.exists(partial_path):
+            raise TransientNetworkError(f"Empty media response: {url}")
+        return digest.hexdigest()
+
+    def download(self, url):
+        if not is_allowed_media_url(url):
+            raise ValueError(f"Media host not allowed: {url}")
+        key = media_key(url)
+        # One transfer per key at a time, so concurrent callers don't share a partial file
+        with self._key_lock(key):
+            return self._download(url, key)
+
+    def _download(self, url, key):
+        cached = self.lookup(url)
+        if cached:
+            return {**cached, "cached": True}
+
+        partial_path = self._partial_path(key)
+        with self._host_slot(url):
+            # A failed transfer leaves the partial file behind, so the retry resumes it
+            sha256 = call_with_retry([("download", lambda: self._stream_to_partial(url, partial_path))],
+                                     max_attempts=3, description=f"media {key}")
+
+        size = os.path.getsize(partial_path)
+        path = self.object_path(sha256)
+        with self._lock:
+            if os.path.exists(path):
+                # Same bytes already stored under another URL
+                os.remove(partial_path)
+            else:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(partial_path, path)
+            self._index["urls"][key] = sha256
+            if sha256 not in self._index["objects"]:
+                self._used += size
+            self._index["objects"][sha256] = {"size": size, "last_access": time.time()}
+            self._evict(keep=sha256)
+            self._dirty = True
+        self._flush_if_due()
+        return {"sha256": sha256, "size": size, "path": path, "cached": False}
+
+    def _evict(self, keep=None):
+        objects = self._index["objects"]
+        if self._used <= self.budget:
+            return
+        for sha256, entry in sorted(objects.items(), key=lambda item: item[1]["last_access"]):
+            if self._used <= self.budget:
+                break
+            if sha256 == keep:
+                continue
+            try:
+                os.remove(self.object_path(sha256))
+            except FileNotFoundError:
+                pass
+            self._used -= entry["size"]
+            del objects[sha256]
+            logger.info(f"Evicted media object {sha256} ({entry['size']} bytes)")
+        self._index["urls"] = {key: sha256 for key, sha256 in self._index["urls"].items() if sha256 in objects}
+
+    def download_many(self, urls, concurrency=MEDIA_CONCURRENCY):
+        """Download URLs concurrently; returns {url: result or {"error": ...}}"""
+        results = {}
+
+        def fetch(url):
+            try:
+                results[url] = self.download(url)
+            except Exception as e:
+                error = classify_exception(e)
+                logger.error(f"Media download failed for {url}: {error}")
+                results[url] = {"error": f"{error.kind}: {error}"}
+
+        unique_urls = list(dict.fromkeys(urls))
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="media") as executor:
+            list(executor.map(fetch, unique_urls))
+        self.flush()
+        return results
+
+    def usage(self):
+        with self._lock:
+            return {
+                "objects": len(self._index["objects"]),
+                "bytes": self._used,
+                "budget": self.budget,
+            }
+
+
+_media_store = None
+_media_store_lock = threading.Lock()
+
+
+def get_media_store():
+    global _media_store
+    with _media_store_lock:
+        if _media_store is None:
+            _media_store = MediaStore()
+        return _media_store
@@ -0,0 +1,189 @@
+"""Regression and performance runner for the TikTok response parsers.
+
+Runs every parser over the recorded corpus in fixtures/parsers and checks the
+output against the recorded expectation. With ``--perf`` it also times each
+parser and compares throughput and allocations with a local baseline.
+
+    python parser_regression.py                    # equivalence check, exit 1 on any mismatch
+    python parser_regression.py --update           # re-record expected outputs
+    python parser_regression.py --perf --update    # record the perf baseline on this machine
+    python parser_regression.py --perf             # also fail on throughput or allocation regressions
+    python parser_regression.py --only parse_channel
+
+Timings depend on the machine, so the perf baseline is not committed; record
+it with ``--perf --update`` on the host that runs the check, before the change
+being measured.
+"""
+import argparse
+import json
+import logging
+import os
+import sys
+import timeit
+import tracemalloc
+
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'parsers')
+EXPECTED_DIR = os.path.join(FIXTURE_DIR, 'expected')
+BASELINE_PATH = os.path.join(FIXTURE_DIR, 'baseline.json')  # local, ignored by git
+
+THROUGHPUT_TOLERANCE = 0.3  # allowed fractional drop in items/sec and MB/sec
+ALLOCATION_TOLERANCE = 0.2  # allowed fractional growth in peak traced memory and allocated blocks
+PERF_REPEATS = 7  # timed batches per case; the fastest one counts
+
+
+def _load_json(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _load_text(path):
+    with open(path, encoding='utf-8') as f:
+        return f.read()
+
+
+def _parsers():
+    import main
+    import posts
+
+    # name, parser, fixture directories, loader, item counter
+    return [
+        ("parse_channel", main.parse_channel, ("item_list",), _load_json, len),
+        ("parse_api_response", main.parse_api_response, ("item_list", "user_detail"), _load_json,
+         lambda result: len(result["videos"])),
+        ("parse_profile_html", main.parse_profile_html, ("profile_html",), _load_text,
+         lambda result: len(result.get("videos", []))),
+        ("parse_post", posts.parse_post, ("video_detail",), _load_text, lambda result: 1),
+    ]
+
+
+def _cases(directories):
+    for directory in directories:
+        path = os.path.join(FIXTURE_DIR, directory)
+        for name in sorted(os.listdir(path)):
+            yield f"{directory}/{os.path.splitext(name)[0]}", os.path.join(path, name)
+
+
+def _normalize(result):
+    # Compare what the API would serialize, not Python object identity
+    return json.loads(json.dumps(result, sort_keys=True))
+
+
+def _measure(fn, arg):
+    """Calls per second of the fastest of PERF_REPEATS batches.
+
+    Each batch repeats the call until it takes at least 0.2s (timeit's
+    autorange), so microsecond parsers are not timed at clock resolution, and
+    the best batch is the one least disturbed by the rest of the machine.
+    """
+    timer = timeit.Timer(lambda: fn(arg))
+    number, _ = timer.autorange()
+    return number / min(timer.repeat(repeat=PERF_REPEATS, number=number))
+
+
+def _allocations(fn, arg):
+    tracemalloc.start()
+    try:
+        before = tracemalloc.take_snapshot()
+        fn(arg)
+        after = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    blocks = sum(stat.count_diff for stat in after.compare_to(before, 'filename') if stat.count_diff > 0)
+    return peak, blocks
+
+
+def run(only=None, update=False, perf=False):
+    # Keep parser log output off the console without bypassing the logging calls themselves
+    for name in ('main_logger', 'scraper_logger'):
+        logging.getLogger(name).addHandler(logging.NullHandler())
+
+    baseline = {} if update or not perf or not os.path.exists(BASELINE_PATH) else _load_json(BASELINE_PATH)
+    new_baseline = {}
+    failures = []
+    if perf and not update and not baseline:
+        failures.append(f"no perf baseline at {os.path.relpath(BASELINE_PATH)}; record one with --perf --update")
+
+    if perf:
+        print(f"{'case':<52} {'items/s':>10} {'MB/s':>8} {'peak KiB':>9} {'blocks':>7}")
+    for parser_name, parser, directories, loader, count_items in _parsers():
+        if only and parser_name not in only:
+            continue
+        for case, path in _cases(directories):
+            key = f"{parser_name}:{case}"
+            arg = loader(path)
+            size_mb = os.path.getsize(path) / 1e6
+
+            try:
+                result = _normalize(parser(arg))
+            except Exception as e:
+                result = {"__error__": f"{type(e).__name__}: {e}"}
+            expected_path = os.path.join(EXPECTED_DIR, parser_name, case.replace('/', '__') + '.json')
+            if update:
+                os.makedirs(os.path.dirname(expected_path), exist_ok=True)
+                with open(expected_path, 'w', encoding='utf-8') as f:
+                    json.dump(result, f, indent=1, sort_keys=True, ensure_ascii=False)
+            elif not os.path.exists(expected_path):
+                failures.append(f"{key}: no expected output recorded")
+            elif _load_json(expected_path) != result:
+                failures.append(f"{key}: output differs from {os.path.relpath(expected_path)}")
+
+            if not perf:
+                continue
+            if "__error__" in result:
+                print(f"{key:<52} {'raises':>10}")
+                continue
+            items = count_items(result)
+            calls_per_second = _measure(parser, arg)
+            peak, blocks = _allocations(parser, arg)
+            stats = {
+                "items_per_second": round(items * calls_per_second, 1),
+                "mb_per_second": round(size_mb * calls_per_second, 3),
+                "peak_bytes": peak,
+                "blocks": blocks,
+            }
+            new_baseline[key] = stats
+            print(f"{key:<52} {stats['items_per_second']:>10.0f} {stats['mb_per_second']:>8.2f} "
+                  f"{peak / 1024:>9.1f} {blocks:>7}")
+
+            reference = baseline.get(key)
+            if reference is None:
+                continue
+            for metric in ("items_per_second", "mb_per_second"):
+                if reference[metric] and stats[metric] < reference[metric] * (1 - THROUGHPUT_TOLERANCE):
+                    failures.append(f"{key}: {metric} {stats[metric]} below baseline {reference[metric]}")
+            if stats["peak_bytes"] > reference["peak_bytes"] * (1 + ALLOCATION_TOLERANCE):
+                failures.append(f"{key}: peak_bytes {stats['peak_bytes']} above baseline {reference['peak_bytes']}")
+            if stats["blocks"] > reference["blocks"] * (1 + ALLOCATION_TOLERANCE):
+                failures.append(f"{key}: blocks {stats['blocks']} above baseline {reference['blocks']}")
+
+    if update:
+        if perf:
+            if only and os.path.exists(BASELINE_PATH):
+                new_baseline = {**_load_json(BASELINE_PATH), **new_baseline}
+            with open(BASELINE_PATH, 'w', encoding='utf-8') as f:
+                json.dump(new_baseline, f, indent=1, sort_keys=True)
+            print(f"Recorded expected outputs and perf baseline for {len(new_baseline)} cases")
+        else:
+            print("Recorded expected outputs")
+        return 0
+
+    for failure in failures:
+        print(f"FAIL {failure}")
+    if not failures:
+        print("All parser outputs match")
+    return 1 if failures else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--update', action='store_true',
+                        help="re-record expected outputs, and the perf baseline with --perf")
+    parser.add_argument('--perf', action='store_true', help="also measure throughput and allocations")
+    parser.add_argument('--only', action='append', help="restrict to a parser, may be repeated")
+    args = parser.parse_args()
+    sys.exit(run(only=args.only, update=args.update, perf=args.perf))
+
+
+if __name__ == '__main__':
+    main()
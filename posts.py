@@ -0,0 +1,215 @@
+import asyncio
+import json
+import logging
+import os
+import re
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from rate_limiter import rate_limiter, BLOCKED
+from retry_policy import call_with_retry, classify_exception, ParseError, NotFoundError, BlockedError
+from scraper import get_http_session
+from browser_state import state_cache
+from tracing import span, traced, bind
+
+logger = logging.getLogger('scraper_logger')
+
+POSTS_CONCURRENCY = int(os.environ.get('POSTS_CONCURRENCY', '16'))
+POSTS_BROWSER_CONCURRENCY = int(os.environ.get('POSTS_BROWSER_CONCURRENCY', '2'))
+MAX_POSTS_PER_REQUEST = int(os.environ.get('MAX_POSTS_PER_REQUEST', '1000'))
+
+HYDRATION_SCRIPT_IDS = ("__UNIVERSAL_DATA_FOR_REHYDRATION__", "SIGI_STATE")
+VIDEO_PATH_PATTERN = re.compile(r"^/@([\w.-]*)/video/(\d+)/?$")
+# webapp.video-detail statusCode values for deleted / missing videos
+POST_NOT_FOUND_CODES = (10204, 10216)
+
+_fetch_executor = None
+
+
+def normalize_post(id_or_url):
+    """Return (video_id, url) for a bare video id or a TikTok video URL.
+
+    The URL that gets fetched is always rebuilt on www.tiktok.com from the id
+    (and author, if given), never taken from the caller.
+    """
+    value = id_or_url.strip()
+    if value.isdigit():
+        # TikTok redirects /@/video/<id> to the canonical author URL
+        return value, f"https://www.tiktok.com/@/video/{value}"
+    parts = urlsplit(value)
+    host = (parts.hostname or "").lower()
+    if parts.scheme not in ("http", "https") or not (host == "tiktok.com" or host.endswith(".tiktok.com")):
+        raise ValueError(f"Not a TikTok video id or URL: {id_or_url}")
+    match = VIDEO_PATH_PATTERN.match(parts.path)
+    if not match:
+        raise ValueError(f"Not a TikTok video id or URL: {id_or_url}")
+    author, video_id = match.groups()
+    return video_id, f"https://www.tiktok.com/@{author or ''}/video/{video_id}"
+
+
+def extract_hydration_json(html):
+    """Slice the hydration JSON out of a page by string search, without building a DOM"""
+    for script_id in HYDRATION_SCRIPT_IDS:
+        marker = html.find(f'id="{script_id}"')
+        if marker == -1:
+            continue
+        start = html.find('>', marker) + 1
+        end = html.find('</script>', start)
+        if start == 0 or end == -1:
+            continue
+        return json.loads(html[start:end])
+    raise ParseError("Hydration script not found in page")
+
+
+def parse_item(post):
+    """Reduce a raw itemStruct / itemList entry to the fields the service returns"""
+    video = post.get("video") or {}
+    author = post.get("author")
+    result = {
+        "createTime": post.get("createTime"),
+        "desc": post.get("desc"),
+        "id": post.get("id"),
+        "stats": post.get("stats"),
+        "video": {
+            "duration": video.get("duration"),
+            "ratio": video.get("ratio"),
+            "cover": video.get("cover"),
+            "playAddr": video.get("playAddr"),
+            "downloadAddr": video.get("downloadAddr")
+        }
+    }
+    if isinstance(author, dict):
+        result["author"] = {"id": author.get("id"), "uniqueId": author.get("uniqueId")}
+    return result
+
+
+@traced()
+def parse_post(html):
+    """Parse a single video page into the parse_item shape"""
+    data = extract_hydration_json(html)
+    scope = data.get("__DEFAULT_SCOPE__", data)
+    detail = scope.get("webapp.video-detail")
+    if detail is None:
+        raise ParseError("webapp.video-detail missing from hydration data")
+    if detail.get("statusCode") in POST_NOT_FOUND_CODES:
+        raise NotFoundError(f"Video not found (statusCode {detail.get('statusCode')})")
+    try:
+        item = detail["itemInfo"]["itemStruct"]
+    except (KeyError, TypeError):
+        raise ParseError(f"itemStruct missing from video detail (statusCode {detail.get('statusCode')})")
+    return parse_item(item)
+
+
+def fetch_post(url):
+    rate_limiter.acquire_sync(None, "post_detail")
+    with span("fetch", url=url, engine="http") as info:
+        response = get_http_session().get(url, timeout=15)
+        info["status"] = response.status_code
+    if response.status_code == 404:
+        raise NotFoundError(f"Video not found: {url}")
+    if rate_limiter.observe(None, "post_detail", response.status_code, response.text) == BLOCKED:
+        raise BlockedError(f"Blocked fetching {url}")
+    response.raise_for_status()
+    return parse_post(response.text)
+
+
+def _get_fetch_executor():
+    global _fetch_executor
+    if _fetch_executor is None:
+        _fetch_executor = ThreadPoolExecutor(max_workers=POSTS_CONCURRENCY, thread_name_prefix="posts")
+    return _fetch_executor
+
+
+async def fetch_posts_http(targets, concurrency=POSTS_CONCURRENCY):
+    """Fetch {video_id: url} over the pooled HTTP client; returns (posts, errors) keyed by id"""
+    loop = asyncio.get_running_loop()
+    semaphore = asyncio.Semaphore(concurrency)
+    posts, errors = {}, {}
+
+    async def fetch_one(video_id, url):
+        async with semaphore:
+            if rate_limiter.is_flagged(None):
+                # Retrying would only spend the retry budget /scrape relies on
+                errors[video_id] = BlockedError("Direct identity is flagged as blocked")
+                return
+            try:
+                posts[video_id] = await loop.run_in_executor(
+                    _get_fetch_executor(), bind(lambda: call_with_retry(
+                        [("http", lambda: fetch_post(url))], max_attempts=2, description=f"post {video_id}")))
+            except Exception as e:
+                errors[video_id] = classify_exception(e)
+
+    await asyncio.gather(*(fetch_one(video_id, url) for video_id, url in targets.items()))
+    return posts, errors
+
+
+async def fetch_posts_browser(targets, concurrency=POSTS_BROWSER_CONCURRENCY):
+    """Fallback for ids the HTTP path couldn't parse: one browser, a few pages at a time"""
+    from playwright.async_api import async_playwright
+
+    posts, errors = {}, {}
+    semaphore = asyncio.Semaphore(concurrency)
+    async with async_playwright() as p:
+        with span("browser_create"):
+            browser = await p.chromium.launch(headless=True)
+            context = await browser.new_context(user_agent=get_http_session().headers["User-Agent"],
+                                                storage_state=state_cache.get(None))
+
+        async def fetch_one(video_id, url):
+            async with semaphore:
+                page = await context.new_page()
+                try:
+                    await rate_limiter.acquire(None, "post_detail")
+                    with span("navigate", url=url, engine="playwright"):
+                        await page.goto(url, wait_until="domcontentloaded", timeout=30000)
+                    html = await page.content()
+                    rate_limiter.observe(None, "post_detail", 200, html)
+                    posts[video_id] = parse_post(html)
+                except Exception as e:
+                    errors[video_id] = classify_exception(e)
+                finally:
+                    await page.close()
+
+        try:
+            await asyncio.gather(*(fetch_one(video_id, url) for video_id, url in targets.items()))
+        finally:
+            await browser.close()
+    return posts, errors
+
+
+async def scrape_posts(ids_or_urls, browser_fallback=True):
+    """Scrape many video pages: pooled HTTP first, browser only for the ids that failed"""
+    targets, errors = {}, {}
+    for value in ids_or_urls:
+        try:
+            video_id, url = normalize_post(value)
+            targets[video_id] = url
+        except ValueError as e:
+            errors[value] = ParseError(str(e))
+
+    posts, http_errors = await fetch_posts_http(targets)
+    logger.info(f"Fetched {len(posts)}/{len(targets)} posts over HTTP")
+
+    # Missing videos won't appear in a browser either, and the browser uses the same
+    # identity, so a blocked fetch would only be blocked again
+    retry_targets = {video_id: targets[video_id] for video_id, error in http_errors.items()
+                     if not isinstance(error, (NotFoundError, BlockedError))}
+    errors.update({video_id: error for video_id, error in http_errors.items() if video_id not in retry_targets})
+    if retry_targets and browser_fallback and rate_limiter.is_flagged(None):
+        logger.warning(f"Direct identity is flagged, not falling back to browser for {len(retry_targets)} posts")
+        browser_fallback = False
+    if retry_targets and browser_fallback:
+        logger.info(f"Falling back to browser for {len(retry_targets)} posts")
+        try:
+            browser_posts, browser_errors = await fetch_posts_browser(retry_targets)
+        except Exception as e:
+            browser_posts, browser_errors = {}, {video_id: classify_exception(e) for video_id in retry_targets}
+        posts.update(browser_posts)
+        errors.update(browser_errors)
+    else:
+        errors.update({video_id: http_errors[video_id] for video_id in retry_targets})
+
+    return {
+        "posts": [posts[video_id] for video_id in targets if video_id in posts],
+        "errors": {key: f"{error.kind}: {error}" for key, error in errors.items()},
+    }
@@ -0,0 +1,313 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+import shared_state
+from retry_policy import BlockedError
+
+logger = logging.getLogger('scraper_logger')
+
+# Response classes returned by classify_response
+OK = "ok"
+EMPTY = "empty"
+BLOCKED = "blocked"
+
+# Tunables, overridable from the environment like the rest of the service settings
+RATE_LIMIT_INITIAL = float(os.environ.get('RATE_LIMIT_INITIAL', '0.5'))  # requests per second
+RATE_LIMIT_MIN = float(os.environ.get('RATE_LIMIT_MIN', '0.05'))
+RATE_LIMIT_MAX = float(os.environ.get('RATE_LIMIT_MAX', '4.0'))
+RATE_LIMIT_INCREASE = float(os.environ.get('RATE_LIMIT_INCREASE', '0.1'))
+RATE_LIMIT_DECREASE = float(os.environ.get('RATE_LIMIT_DECREASE', '0.5'))
+RATE_LIMIT_BURST = float(os.environ.get('RATE_LIMIT_BURST', '2'))
+BLOCK_COOLDOWN = float(os.environ.get('BLOCK_COOLDOWN', '60'))  # seconds, doubled per consecutive block
+BLOCK_COOLDOWN_MAX = float(os.environ.get('BLOCK_COOLDOWN_MAX', '900'))
+EMPTY_BLOCK_THRESHOLD = int(os.environ.get('EMPTY_BLOCK_THRESHOLD', '3'))
+
+# Markup only TikTok's captcha / verification interstitials have. SDK names such as
+# secsdk or verify_center are also loaded by ordinary pages, so they don't count on their own
+CHALLENGE_TITLES = ("security check", "access denied", "please wait...")
+CHALLENGE_ELEMENTS = re.compile(
+    r'\b(?:id|class)="(?:[^"]*\s)?(?:captcha-verify-container|captcha_container|secsdk-captcha[\w-]*)[\s"]')
+TITLE_PATTERN = re.compile(r'<title[^>]*>\s*([^<]*?)\s*</title>', re.IGNORECASE)
+CHALLENGE_SCAN_BYTES = 64 * 1024
+
+
+def is_challenge_page(html):
+    """True if ``html`` is a captcha / verification interstitial rather than a real page"""
+    head = html[:CHALLENGE_SCAN_BYTES]
+    title = TITLE_PATTERN.search(head)
+    if title and title.group(1).lower() in CHALLENGE_TITLES:
+        return True
+    return CHALLENGE_ELEMENTS.search(head) is not None
+
+
+def endpoint_for_url(url):
+    """Map a request URL onto the endpoint bucket it is throttled under"""
+    if "api/post/item_list" in url:
+        return "item_list"
+    if "api/user/detail" in url:
+        return "user_detail"
+    if "/video/" in url:
+        return "post_detail"
+    return "profile"
+
+
+def proxy_key(proxy):
+    """Stable identity of the address TikTok sees: a proxy URL string or "direct".
+
+    A BrowserMob proxy object is only a local relay, so it is keyed on its
+    ``upstream`` proxy, or on "direct" when it leaves from this host.
+    """
+    if not proxy:
+        return "direct"
+    if hasattr(proxy, 'proxy'):
+        return proxy_key(getattr(proxy, 'upstream', None))
+    return str(proxy)
+
+
+def classify_response(status, body):
+    """Classify a TikTok response as blocked, empty or ok.
+
+    ``body`` may be the raw text or an already decoded JSON object.
+    """
+    if status in (403, 429):
+        return BLOCKED
+    if body is None or body == "" or body == {}:
+        return EMPTY
+
+    if isinstance(body, (bytes, bytearray)):
+        body = body.decode('utf-8', errors='replace')
+
+    data = body
+    if isinstance(body, str):
+        try:
+            data = json.loads(body)
+        except json.JSONDecodeError:
+            # Only HTML can be a challenge page; inside JSON the same words may be a video description
+            if is_challenge_page(body):
+                return BLOCKED
+            # HTML pages are fine as long as they are not a challenge page
+            return OK if status < 400 else EMPTY
+
+    if not isinstance(data, dict):
+        return EMPTY
+    if "verifyConfig" in data or "verify_center" in str(data.get("url", "")):
+        return BLOCKED
+    if data.get("itemList"):
+        return OK
+    if data.get("userInfo"):
+        return OK
+    if "itemList" in data or "hasMore" in data or "userInfo" in data:
+        # A well-formed but empty page, e.g. the last cursor or a soft block
+        return EMPTY
+    return EMPTY if status < 400 else BLOCKED
+
+
+class AdaptiveTokenBucket:
+    """Token bucket whose refill rate follows AIMD on observed outcomes"""
+
+    def __init__(self, rate=RATE_LIMIT_INITIAL, min_rate=RATE_LIMIT_MIN, max_rate=RATE_LIMIT_MAX,
+                 increase=RATE_LIMIT_INCREASE, decrease=RATE_LIMIT_DECREASE, burst=RATE_LIMIT_BURST):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.decrease = decrease
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.consecutive_empty = 0
+        self.consecutive_blocks = 0
+        self.flagged_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, now=None):
+        """Take a token and return how long the caller must wait before using it"""
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        self.tokens -= 1
+        wait = 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+        return max(wait, self.flagged_until - now)
+
+    def on_ok(self):
+        self.consecutive_empty = 0
+        self.consecutive_blocks = 0
+        self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_empty(self):
+        self.consecutive_empty += 1
+        if self.consecutive_empty >= EMPTY_BLOCK_THRESHOLD:
+            # Runs of empty pages are how soft blocks usually look
+            self.on_blocked()
+
+    def on_blocked(self):
+        self.consecutive_empty = 0
+        self.consecutive_blocks += 1
+        self.rate = max(self.min_rate, self.rate * self.decrease)
+        cooldown = min(BLOCK_COOLDOWN_MAX, BLOCK_COOLDOWN * (2 ** (self.consecutive_blocks - 1)))
+        self.flagged_until = time.monotonic() + cooldown
+        # Drain the bucket so nothing bursts out right after the cooldown
+        self.tokens = min(self.tokens, 0)
+
+    def is_flagged(self, now=None):
+        now = time.monotonic() if now is None else now
+        return now < self.flagged_until
+
+
+class RateLimiter:
+    """Per-proxy and per-(proxy, endpoint) adaptive buckets.
+
+    A request has to clear both the proxy bucket and the endpoint bucket, so a
+    block on one endpoint slows the whole identity down while healthy endpoints
+    on other proxies keep speeding up.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._proxy_buckets = {}
+        self._endpoint_buckets = {}
+        self._block_listeners = []
+
+    def add_block_listener(self, listener):
+        """Call ``listener(proxy, endpoint)`` whenever a block is recorded"""
+        self._block_listeners.append(listener)
+
+    def _buckets(self, proxy, endpoint):
+        key = proxy_key(proxy)
+        if key not in self._proxy_buckets:
+            self._proxy_buckets[key] = AdaptiveTokenBucket()
+        if (key, endpoint) not in self._endpoint_buckets:
+            self._endpoint_buckets[(key, endpoint)] = AdaptiveTokenBucket()
+        return self._proxy_buckets[key], self._endpoint_buckets[(key, endpoint)]
+
+    def _reserve(self, proxy, endpoint):
+        with self._lock:
+            proxy_bucket, endpoint_bucket = self._buckets(proxy, endpoint)
+            now = time.monotonic()
+            flagged_until = max(proxy_bucket.flagged_until, endpoint_bucket.flagged_until)
+            if flagged_until > now:
+                # Sleeping through a cooldown would hold a scrape slot for minutes; let the
+                # caller move on to another identity or fail the request instead
+                raise BlockedError(f"{proxy_key(proxy)}/{endpoint} is flagged for another "
+                                   f"{flagged_until - now:.0f}s")
+            return max(proxy_bucket.reserve(now), endpoint_bucket.reserve(now))
+
+    async def acquire(self, proxy, endpoint):
+        """Wait for a token; raises BlockedError while the identity is flagged"""
+        wait = self._reserve(proxy, endpoint)
+        if wait > 0:
+            logger.debug(f"Rate limiter: waiting {wait:.2f}s for {proxy_key(proxy)}/{endpoint}")
+            await asyncio.sleep(wait)
+
+    def acquire_sync(self, proxy, endpoint):
+        wait = self._reserve(proxy, endpoint)
+        if wait > 0:
+            logger.debug(f"Rate limiter: waiting {wait:.2f}s for {proxy_key(proxy)}/{endpoint}")
+            time.sleep(wait)
+
+    def record(self, proxy, endpoint, outcome):
+        with self._lock:
+            proxy_bucket, endpoint_bucket = self._buckets(proxy, endpoint)
+            for bucket in (proxy_bucket, endpoint_bucket):
+                if outcome == OK:
+                    bucket.on_ok()
+                elif outcome == BLOCKED:
+                    bucket.on_blocked()
+                else:
+                    bucket.on_empty()
+            rate = endpoint_bucket.rate
+        if outcome == BLOCKED:
+            logger.warning(f"Block detected for {proxy_key(proxy)}/{endpoint}, rate lowered to {rate:.2f}/s")
+            for listener in self._block_listeners:
+                try:
+                    listener(proxy, endpoint)
+                except Exception as e:
+                    logger.error(f"Block listener failed: {e}")
+        else:
+            logger.debug(f"Rate limiter: {outcome} for {proxy_key(proxy)}/{endpoint}, rate {rate:.2f}/s")
+        return outcome
+
+    def observe(self, proxy, endpoint, status, body):
+        """Classify a response and feed the outcome back into the buckets"""
+        return self.record(proxy, endpoint, classify_response(status, body))
+
+    def is_flagged(self, proxy):
+        with self._lock:
+            bucket = self._proxy_buckets.get(proxy_key(proxy))
+            return bool(bucket and bucket.is_flagged())
+
+    def flagged_share(self):
+        """Fraction of known proxy identities currently flagged as blocked"""
+        with self._lock:
+            if not self._proxy_buckets:
+                return 0.0
+            now = time.monotonic()
+            flagged = sum(1 for bucket in self._proxy_buckets.values() if bucket.is_flagged(now))
+            return flagged / len(self._proxy_buckets)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                f"{key}/{endpoint}": {
+                    "rate": round(bucket.rate, 3),
+                    "flagged": bucket.is_flagged(),
+                }
+                for (key, endpoint), bucket in self._endpoint_buckets.items()
+            }
+
+
+class RemoteRateLimiter:
+    """A worker process's view of the API process's RateLimiter (see shared_state).
+
+    Tokens are reserved and outcomes recorded in the API process, so every
+    process draws from the same buckets; responses are classified and waits
+    slept here. Only proxy keys cross the process boundary.
+    """
+
+    def __init__(self, remote):
+        self._remote = remote
+
+    def add_block_listener(self, listener):
+        # Listeners run in the API process, which records the blocks
+        pass
+
+    async def acquire(self, proxy, endpoint):
+        wait = self._remote._reserve(proxy_key(proxy), endpoint)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def acquire_sync(self, proxy, endpoint):
+        wait = self._remote._reserve(proxy_key(proxy), endpoint)
+        if wait > 0:
+            logger.debug(f"Rate limiter: waiting {wait:.2f}s for {proxy_key(proxy)}/{endpoint}")
+            time.sleep(wait)
+
+    def record(self, proxy, endpoint, outcome):
+        return self._remote.record(proxy_key(proxy), endpoint, outcome)
+
+    def observe(self, proxy, endpoint, status, body):
+        return self.record(proxy, endpoint, classify_response(status, body))
+
+    def is_flagged(self, proxy):
+        return self._remote.is_flagged(proxy_key(proxy))
+
+    def flagged_share(self):
+        return self._remote.flagged_share()
+
+    def snapshot(self):
+        return self._remote.snapshot()
+
+
+def _shared_rate_limiter():
+    remote = shared_state.remote("rate_limiter")
+    return RateLimiter() if remote is None else RemoteRateLimiter(remote)
+
+
+rate_limiter = _shared_rate_limiter()
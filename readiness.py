@@ -0,0 +1,86 @@
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger('main_logger')
+
+# Seconds between re-runs of failed checks, so a transient failure at start-up doesn't stick
+READINESS_RECHECK_INTERVAL = float(os.environ.get('READINESS_RECHECK_INTERVAL', '30'))
+
+PENDING = "pending"
+PASSED = "ok"
+FAILED = "failed"
+
+
+class ReadinessProbe:
+    """Runs startup checks in a background thread and keeps their results for /healthz.
+
+    A check is any callable; returning False or raising marks it failed. Failed
+    required checks keep the node unready, failed optional checks only mark it
+    degraded.
+    """
+
+    def __init__(self, recheck_interval=READINESS_RECHECK_INTERVAL):
+        self.recheck_interval = recheck_interval
+        self._lock = threading.Lock()
+        self._checks = []
+        self._results = {}
+        self._thread = None
+        self.started_at = None
+
+    def add_check(self, name, fn, required=True):
+        with self._lock:
+            self._checks.append((name, fn, required))
+            self._results[name] = {"status": PENDING, "required": required}
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self.started_at = time.monotonic()
+        self._thread = threading.Thread(target=self._run, name="readiness-probe", daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        pending = list(self._checks)
+        while True:
+            pending = [check for check in pending if not self._run_check(*check)]
+            if not pending or self.recheck_interval <= 0:
+                return
+            time.sleep(self.recheck_interval)
+
+    def _run_check(self, name, fn, required):
+        started = time.monotonic()
+        try:
+            passed = fn() is not False
+            error = None
+        except Exception as e:
+            passed = False
+            error = str(e)
+        duration = round(time.monotonic() - started, 3)
+        with self._lock:
+            self._results[name] = {
+                "status": PASSED if passed else FAILED,
+                "required": required,
+                "duration": duration,
+            }
+            if error:
+                self._results[name]["error"] = error
+        logger.info(f"Readiness check {name}: {'ok' if passed else 'failed'} in {duration}s")
+        return passed
+
+    def report(self):
+        with self._lock:
+            checks = {name: dict(result) for name, result in self._results.items()}
+        if any(result["status"] == PENDING for result in checks.values()):
+            status = "starting"
+        elif any(result["status"] == FAILED and result["required"] for result in checks.values()):
+            status = "unready"
+        elif any(result["status"] == FAILED for result in checks.values()):
+            status = "degraded"
+        else:
+            status = "ready"
+        return {"status": status, "checks": checks}
+
+
+readiness_probe = ReadinessProbe()
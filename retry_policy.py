@@ -0,0 +1,191 @@
+import asyncio
+import collections
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+
+import shared_state
+from tracing import span
+
+logger = logging.getLogger('main_logger')
+
+MAX_ATTEMPTS_PER_REQUEST = int(os.environ.get('MAX_ATTEMPTS_PER_REQUEST', '3'))
+RETRY_BUDGET_RATIO = float(os.environ.get('RETRY_BUDGET_RATIO', '0.2'))  # retries per request, process wide
+RETRY_BUDGET_MIN = int(os.environ.get('RETRY_BUDGET_MIN', '5'))  # retries always allowed per window
+RETRY_BUDGET_WINDOW = float(os.environ.get('RETRY_BUDGET_WINDOW', '60'))  # seconds
+RETRY_BACKOFF_BASE = float(os.environ.get('RETRY_BACKOFF_BASE', '1'))
+RETRY_BACKOFF_MAX = float(os.environ.get('RETRY_BACKOFF_MAX', '8'))
+
+
+class ScrapeError(Exception):
+    """Base class for classified scrape failures"""
+    kind = "unknown"
+    retryable = False
+
+
+class TransientNetworkError(ScrapeError):
+    kind = "transient"
+    retryable = True
+
+
+class BlockedError(ScrapeError):
+    kind = "blocked"
+    retryable = True
+
+
+class ParseError(ScrapeError):
+    kind = "parse"
+    retryable = True
+
+
+class NotFoundError(ScrapeError):
+    kind = "not_found"
+    retryable = False
+
+
+class InfraError(ScrapeError):
+    kind = "infra"
+    retryable = True
+
+
+# Exception class names from requests / selenium / playwright / urllib3, matched by
+# name so this module doesn't have to import any of those libraries
+TRANSIENT_ERROR_NAMES = {
+    "TimeoutError", "TimeoutException", "Timeout", "ReadTimeout", "ConnectTimeout",
+    "ConnectionError", "ChunkedEncodingError", "ProtocolError", "RemoteDisconnected",
+    "ConnectionResetError", "ConnectionRefusedError", "ProxyError",
+}
+INFRA_ERROR_NAMES = {
+    "WebDriverException", "SessionNotCreatedException", "NoSuchDriverException",
+    "FileNotFoundError", "PermissionError", "ProxyServerError",
+}
+# Playwright raises its plain ``Error`` for Chromium network failures, e.g.
+# "net::ERR_CONNECTION_RESET at https://..." or "Page.goto: net::ERR_..."
+CHROMIUM_NET_ERROR = re.compile(r'^(?:[\w.]+: )?net::ERR_')
+
+
+def classify_exception(exc):
+    """Wrap an arbitrary exception in the matching ScrapeError subclass"""
+    if isinstance(exc, ScrapeError):
+        return exc
+    names = {cls.__name__ for cls in type(exc).__mro__}
+    if names & TRANSIENT_ERROR_NAMES or CHROMIUM_NET_ERROR.match(str(exc)):
+        error = TransientNetworkError(str(exc))
+    elif isinstance(exc, (json.JSONDecodeError, KeyError, ValueError, TypeError)):
+        error = ParseError(str(exc))
+    elif names & INFRA_ERROR_NAMES:
+        error = InfraError(str(exc))
+    elif isinstance(exc, OSError):
+        error = TransientNetworkError(str(exc))
+    else:
+        error = ScrapeError(str(exc))
+    error.__cause__ = exc
+    return error
+
+
+class RetryBudget:
+    """Process wide cap on retries as a fraction of recent requests.
+
+    Stops retry storms during incidents: once every request is failing, the
+    number of extra browser sessions is bounded by ``ratio`` instead of being
+    multiplied by the per-request attempt count.
+    """
+
+    def __init__(self, ratio=RETRY_BUDGET_RATIO, min_retries=RETRY_BUDGET_MIN, window=RETRY_BUDGET_WINDOW):
+        self.ratio = ratio
+        self.min_retries = min_retries
+        self.window = window
+        self._requests = collections.deque()
+        self._retries = collections.deque()
+        self._lock = threading.Lock()
+
+    def _trim(self, now):
+        for events in (self._requests, self._retries):
+            while events and now - events[0] > self.window:
+                events.popleft()
+
+    def record_request(self):
+        with self._lock:
+            now = time.monotonic()
+            self._trim(now)
+            self._requests.append(now)
+
+    def try_retry(self):
+        with self._lock:
+            now = time.monotonic()
+            self._trim(now)
+            allowed = self.min_retries + self.ratio * len(self._requests)
+            if len(self._retries) >= allowed:
+                return False
+            self._retries.append(now)
+            return True
+
+    def snapshot(self):
+        with self._lock:
+            self._trim(time.monotonic())
+            return {"requests": len(self._requests), "retries": len(self._retries)}
+
+
+# Worker processes share the API process's budget instead of each getting a fresh one
+retry_budget = shared_state.remote("retry_budget") or RetryBudget()
+
+
+def backoff_delay(attempt):
+    """Exponential backoff with full jitter for the given retry number (1-based)"""
+    return random.uniform(0, min(RETRY_BACKOFF_MAX, RETRY_BACKOFF_BASE * (2 ** (attempt - 1))))
+
+
+def _next_attempt(error, attempt, max_attempts, budget, description):
+    if not error.retryable:
+        logger.warning(f"{description}: {error.kind} error is not retryable: {error}")
+        return False
+    if attempt + 1 >= max_attempts:
+        logger.error(f"{description}: giving up after {max_attempts} attempts: {error}")
+        return False
+    if not budget.try_retry():
+        logger.error(f"{description}: process retry budget exhausted, not retrying: {error}")
+        return False
+    logger.warning(f"{description}: {error.kind} error on attempt {attempt + 1}/{max_attempts}: {error}")
+    return True
+
+
+def call_with_retry(strategies, max_attempts=MAX_ATTEMPTS_PER_REQUEST, budget=retry_budget, description="scrape"):
+    """Call ``strategies`` in rotation until one succeeds.
+
+    ``strategies`` is a list of ``(name, fn)`` pairs; each attempt moves on to
+    the next one so a retry runs on a different engine or proxy than the call
+    that just failed. Non-retryable errors are raised straight away.
+    """
+    budget.record_request()
+    for attempt in range(max_attempts):
+        name, fn = strategies[attempt % len(strategies)]
+        try:
+            with span("attempt", strategy=name, attempt=attempt + 1, description=description):
+                return fn()
+        except Exception as exc:
+            error = classify_exception(exc)
+            if not _next_attempt(error, attempt, max_attempts, budget, f"{description} [{name}]"):
+                raise error
+        with span("backoff", attempt=attempt + 1):
+            time.sleep(backoff_delay(attempt + 1))
+
+
+async def async_call_with_retry(strategies, max_attempts=MAX_ATTEMPTS_PER_REQUEST, budget=retry_budget,
+                                description="scrape"):
+    """Async counterpart of call_with_retry for coroutine functions"""
+    budget.record_request()
+    for attempt in range(max_attempts):
+        name, fn = strategies[attempt % len(strategies)]
+        try:
+            with span("attempt", strategy=name, attempt=attempt + 1, description=description):
+                return await fn()
+        except Exception as exc:
+            error = classify_exception(exc)
+            if not _next_attempt(error, attempt, max_attempts, budget, f"{description} [{name}]"):
+                raise error
+        with span("backoff", attempt=attempt + 1):
+            await asyncio.sleep(backoff_delay(attempt + 1))
@@ -0,0 +1,221 @@
+import asyncio
+import collections
+import heapq
+import itertools
+import logging
+import os
+import time
+
+from rate_limiter import rate_limiter
+from worker_pool import worker_count
+
+logger = logging.getLogger('main_logger')
+
+# Highest priority first; a class only runs while every class above it has an empty queue
+PRIORITY_CLASSES = ("interactive", "normal", "bulk")
+DEFAULT_PRIORITY = "normal"
+
+SCHED_CAPACITY = int(os.environ.get('SCHED_CAPACITY', str(worker_count())))  # concurrent scrapes
+# Slots only interactive requests may use, so they never queue behind a full pool of bulk work
+SCHED_INTERACTIVE_RESERVE = int(os.environ.get('SCHED_INTERACTIVE_RESERVE', '1'))
+SCHED_MAX_QUEUED = {
+    "interactive": int(os.environ.get('SCHED_MAX_QUEUED_INTERACTIVE', '100')),
+    "normal": int(os.environ.get('SCHED_MAX_QUEUED_NORMAL', '1000')),
+    "bulk": int(os.environ.get('SCHED_MAX_QUEUED_BULK', '10000')),
+}
+SCHED_RECHECK_INTERVAL = float(os.environ.get('SCHED_RECHECK_INTERVAL', '1'))  # seconds
+SCHED_WAIT_SAMPLES = 1000
+
+
+def parse_client_weights(value):
+    """Parse ``client=weight,client=weight`` into a dict"""
+    weights = {}
+    for entry in filter(None, (part.strip() for part in value.split(','))):
+        client_id, _, weight = entry.partition('=')
+        weights[client_id.strip()] = float(weight)
+    return weights
+
+
+SCHED_CLIENT_WEIGHTS = parse_client_weights(os.environ.get('SCHED_CLIENT_WEIGHTS', ''))
+
+
+class QueueFullError(Exception):
+    """The priority class's queue is at its limit; the client should back off"""
+
+
+class _Job:
+    __slots__ = ("client_id", "priority", "sequence", "enqueued", "future")
+
+    def __init__(self, client_id, future):
+        self.client_id = client_id
+        self.priority = None
+        self.sequence = None
+        self.enqueued = time.monotonic()
+        self.future = future
+
+
+def _percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+class FairScheduler:
+    """Admission control for scrapes with priority classes and per-client fair queuing.
+
+    Classes are served in strict priority order. Within a class, clients share
+    the slots in proportion to their weight: each job gets a virtual finish
+    tag ``max(class virtual time, client's last tag) + 1 / weight`` and the
+    smallest tag runs first, so a client with 5,000 queued usernames gets no
+    more turns than one with a single lookup. A queued job moves up a class
+    when a more urgent request shares it (see promote). The number of
+    concurrent scrapes follows the configured capacity, scaled down by the
+    share of proxy identities the rate limiter currently has flagged.
+
+    All methods are called from the event loop thread and need no locking.
+    """
+
+    def __init__(self, capacity=SCHED_CAPACITY, reserve=SCHED_INTERACTIVE_RESERVE, max_queued=None,
+                 weights=None):
+        self.max_capacity = capacity
+        self.reserve = reserve
+        self.max_queued = dict(SCHED_MAX_QUEUED if max_queued is None else max_queued)
+        self.weights = dict(SCHED_CLIENT_WEIGHTS if weights is None else weights)
+        self._queues = {priority: [] for priority in PRIORITY_CLASSES}
+        self._virtual_time = {priority: 0.0 for priority in PRIORITY_CLASSES}
+        self._client_tags = {}
+        self._queued = {priority: 0 for priority in PRIORITY_CLASSES}
+        self._running = {priority: 0 for priority in PRIORITY_CLASSES}
+        self._waits = {priority: collections.deque(maxlen=SCHED_WAIT_SAMPLES) for priority in PRIORITY_CLASSES}
+        self._counters = {priority: collections.Counter() for priority in PRIORITY_CLASSES}
+        self._sequence = itertools.count()
+        self._recheck = None
+
+    def capacity(self):
+        healthy = 1.0 - rate_limiter.flagged_share()
+        return max(1, round(self.max_capacity * healthy))
+
+    def _limit(self, priority, capacity):
+        if priority == PRIORITY_CLASSES[0]:
+            return capacity
+        return max(1, capacity - self.reserve)
+
+    def _dispatch(self):
+        capacity = self.capacity()
+        for priority in PRIORITY_CLASSES:
+            queue = self._queues[priority]
+            while queue and sum(self._running.values()) < self._limit(priority, capacity):
+                tag, sequence, job = heapq.heappop(queue)
+                if job.sequence != sequence or job.future.done():
+                    # Moved to a higher class by promote(), or the caller went away while queued
+                    continue
+                self._queued[priority] -= 1
+                self._virtual_time[priority] = tag
+                self._running[priority] += 1
+                self._counters[priority]["admitted"] += 1
+                wait = time.monotonic() - job.enqueued
+                self._waits[priority].append(wait)
+                job.future.set_result(wait)
+            if self._queued[priority]:
+                break
+        if self._recheck is None and any(self._queued.values()):
+            # One timer for the whole queue: capacity may come back as proxy flags expire
+            self._recheck = asyncio.get_running_loop().call_later(SCHED_RECHECK_INTERVAL, self._on_recheck)
+
+    def _on_recheck(self):
+        self._recheck = None
+        self._dispatch()
+
+    def _prune_client_tags(self):
+        self._client_tags = {key: tag for key, tag in self._client_tags.items()
+                             if tag > self._virtual_time[key[0]]}
+
+    def _enqueue(self, job, client_id, priority):
+        key = (priority, client_id)
+        tag = max(self._virtual_time[priority], self._client_tags.get(key, 0.0)) + 1.0 / self.weights.get(client_id, 1.0)
+        self._client_tags[key] = tag
+        if len(self._client_tags) > 10 * SCHED_WAIT_SAMPLES:
+            self._prune_client_tags()
+        job.priority = priority
+        job.sequence = next(self._sequence)
+        heapq.heappush(self._queues[priority], (tag, job.sequence, job))
+        self._queued[priority] += 1
+
+    def _check_priority(self, priority):
+        if priority not in PRIORITY_CLASSES:
+            raise ValueError(f"Unknown priority {priority!r}, expected one of {', '.join(PRIORITY_CLASSES)}")
+
+    def submit(self, client_id, priority=DEFAULT_PRIORITY):
+        """Queue a job without waiting for it; pass the result to wait() and release()"""
+        self._check_priority(priority)
+        if self._queued[priority] >= self.max_queued[priority]:
+            self._counters[priority]["rejected"] += 1
+            raise QueueFullError(f"{priority} queue is full ({self._queued[priority]} waiting)")
+        job = _Job(client_id, asyncio.get_running_loop().create_future())
+        self._enqueue(job, client_id, priority)
+        self._dispatch()
+        return job
+
+    def promote(self, job, client_id, priority):
+        """Move a still queued job up to ``priority`` when a more urgent caller shares it"""
+        self._check_priority(priority)
+        if job.future.done() or PRIORITY_CLASSES.index(priority) >= PRIORITY_CLASSES.index(job.priority):
+            return False
+        if self._queued[priority] >= self.max_queued[priority]:
+            # Coalescing must not get past the target class's queue limit; the caller still shares the job
+            logger.info(f"Not promoting queued {job.priority} job for {client_id}: {priority} queue is full")
+            return False
+        logger.info(f"Promoting queued {job.priority} job to {priority} for {client_id}")
+        # The old heap entry is left behind and skipped by its stale sequence number
+        self._queued[job.priority] -= 1
+        self._enqueue(job, client_id, priority)
+        self._dispatch()
+        return True
+
+    async def wait(self, job):
+        """Wait until ``job`` is admitted; returns the seconds spent queued"""
+        try:
+            return await asyncio.shield(job.future)
+        except asyncio.CancelledError:
+            if job.future.done() and not job.future.cancelled():
+                self.release(job)
+            else:
+                job.future.cancel()
+                self._queued[job.priority] -= 1
+            self._counters[job.priority]["cancelled"] += 1
+            raise
+
+    async def acquire(self, client_id, priority=DEFAULT_PRIORITY):
+        """Queue and wait for a scrape slot; returns the admitted job for release()"""
+        job = self.submit(client_id, priority)
+        await self.wait(job)
+        return job
+
+    def release(self, job):
+        self._running[job.priority] -= 1
+        self._counters[job.priority]["completed"] += 1
+        self._dispatch()
+
+    def metrics(self):
+        classes = {}
+        for priority in PRIORITY_CLASSES:
+            waits = self._waits[priority]
+            classes[priority] = {
+                "queued": self._queued[priority],
+                "running": self._running[priority],
+                **{name: self._counters[priority][name] for name in ("admitted", "completed", "rejected", "cancelled")},
+                "wait_seconds": {
+                    "samples": len(waits),
+                    "p50": round(_percentile(waits, 0.5), 3) if waits else None,
+                    "p95": round(_percentile(waits, 0.95), 3) if waits else None,
+                    "max": round(max(waits), 3) if waits else None,
+                },
+            }
+        return {
+            "capacity": self.capacity(),
+            "max_capacity": self.max_capacity,
+            "proxy_flagged_share": round(rate_limiter.flagged_share(), 3),
+            "classes": classes,
+        }
+
+
+scrape_scheduler = FairScheduler()
@@ -0,0 +1,269 @@
+"""Behaviour checks for the scrape pipeline that run without a browser or network.
+
+Each check drives one component with fake pages, routes or clocks and raises
+AssertionError when it misbehaves.
+
+    python scrape_checks.py                        # run every check, exit 1 on any failure
+    python scrape_checks.py --only retry_classification
+"""
+import argparse
+import logging
+import sys
+import traceback
+
+
+def check_retry_classification():
+    from playwright.async_api import Error as PlaywrightError
+    from playwright.async_api import TimeoutError as PlaywrightTimeoutError
+    from retry_policy import (classify_exception, TransientNetworkError, ParseError, ScrapeError,
+                              async_call_with_retry, RetryBudget)
+    import asyncio
+
+    for message in ("net::ERR_CONNECTION_RESET at https://www.tiktok.com/@user",
+                    "Page.goto: net::ERR_TIMED_OUT at https://www.tiktok.com/@user"):
+        error = classify_exception(PlaywrightError(message))
+        assert isinstance(error, TransientNetworkError), (message, type(error))
+    assert isinstance(classify_exception(PlaywrightTimeoutError("Timeout 30000ms exceeded")), TransientNetworkError)
+    assert isinstance(classify_exception(ValueError("bad")), ParseError)
+    error = classify_exception(PlaywrightError("Target page, context or browser has been closed"))
+    assert type(error) is ScrapeError and not error.retryable
+
+    calls = []
+
+    async def goto():
+        calls.append(1)
+        if len(calls) < 3:
+            raise PlaywrightError("net::ERR_CONNECTION_RESET at https://www.tiktok.com/@user")
+        return "ok"
+
+    result = asyncio.run(async_call_with_retry([("goto", goto)], max_attempts=3, budget=RetryBudget(min_retries=10)))
+    assert result == "ok" and len(calls) == 3, calls
+
+
+def check_block_detection():
+    import json
+    import os
+    from rate_limiter import classify_response, proxy_key, BLOCKED, OK
+
+    profile_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'parsers', 'profile_html')
+    for name in sorted(os.listdir(profile_dir)):
+        with open(os.path.join(profile_dir, name), encoding='utf-8') as f:
+            html = f.read()
+        expected = BLOCKED if name.startswith('challenge') else OK
+        assert classify_response(200, html) == expected, name
+    page = {"itemList": [{"id": "1", "desc": "captcha verify_center speedrun"}], "hasMore": True}
+    assert classify_response(200, json.dumps(page)) == OK
+
+    class BrowserMobClient:
+        proxy = "localhost:8081"
+
+    relay = BrowserMobClient()
+    assert proxy_key(relay) == proxy_key(None) == "direct"
+    relay.upstream = "10.0.0.5:3128"
+    assert proxy_key(relay) == "10.0.0.5:3128"
+
+
+class FakeScrollPage:
+    """Page stand-in for ScrollEngine: a fixed-height document that can emit
+    item_list responses and DOM mutations. Waits run at 1/100 of their timeout."""
+
+    def __init__(self, responses=0, churn=False, height=4000, viewport=800):
+        self.responses = responses
+        self.churn = churn
+        self.height = height
+        self.viewport = viewport
+        self.scroll_y = 0
+        self.mutations = 0
+
+    async def evaluate(self, script, arg=None):
+        import scroll_engine
+        if script == scroll_engine.READ_POSITION:
+            return {"mutations": self.mutations, "scrollY": self.scroll_y,
+                    "viewport": self.viewport, "height": self.height}
+        if script == scroll_engine.SCROLL_BY:
+            self.scroll_y = max(0, min(self.height - self.viewport, self.scroll_y + arg))
+
+    async def wait_for_event(self, event, predicate=None, timeout=None):
+        import asyncio
+        from playwright.async_api import TimeoutError as PlaywrightTimeoutError
+
+        if self.responses:
+            self.responses -= 1
+            await asyncio.sleep(0.001)
+            self.height += 2000
+            return type("Response", (), {"url": "https://www.tiktok.com/api/post/item_list/?cursor=0"})()
+        await asyncio.sleep(timeout / 1000 / 100)
+        raise PlaywrightTimeoutError(f"Timeout {timeout}ms exceeded")
+
+    async def wait_for_function(self, expression, arg=None, polling=None, timeout=None):
+        import asyncio
+        from playwright.async_api import TimeoutError as PlaywrightTimeoutError
+
+        if self.churn:
+            self.mutations += 5
+            return True
+        await asyncio.sleep(timeout / 1000 / 100)
+        raise PlaywrightTimeoutError(f"Timeout {timeout}ms exceeded")
+
+
+def check_scroll_engine():
+    import asyncio
+    from scroll_engine import ScrollEngine
+
+    # Every item_list page arrives: stops at the target
+    result = asyncio.run(ScrollEngine(FakeScrollPage(responses=100), target_pages=4).run())
+    assert result["pages"] == 4, result
+
+    # Constant DOM churn at the bottom with no item_list responses: idle, not progress
+    page = FakeScrollPage(churn=True)
+    result = asyncio.run(ScrollEngine(page, target_pages=15, max_idle_rounds=3).run())
+    assert result["pages"] == 0 and page.mutations > 0, result
+    assert result["rounds"] <= 3 + page.height // page.viewport, result
+
+    # Two pages, then the profile runs dry
+    result = asyncio.run(ScrollEngine(FakeScrollPage(responses=2, churn=True), target_pages=15).run())
+    assert result["pages"] == 2 and result["rounds"] < 30, result
+
+
+class FakeRoute:
+    """Route/request stand-in for intercept_xhr; ``fetch`` answers with ``body``"""
+
+    def __init__(self, url, body=""):
+        self.request = type("Request", (), {"url": url, "method": "GET", "headers": {}})()
+        self.body = body
+        self.outcome = None
+
+    async def fetch(self, headers=None):
+        body = self.body
+
+        class Response:
+            status = 200
+            headers = {}
+
+            async def text(self):
+                return body
+
+        return Response()
+
+    async def fulfill(self, response=None, body=None):
+        self.outcome = "fulfilled"
+
+    async def continue_(self):
+        self.outcome = "continued"
+
+    async def abort(self):
+        self.outcome = "aborted"
+
+
+class FakeRoutePage:
+    async def route(self, pattern, handler):
+        self.handler = handler
+
+    async def serve(self, route):
+        await self.handler(route, route.request)
+        return route.outcome
+
+
+class StalledSink:
+    """A sink whose consumer went away: ``put`` never returns"""
+
+    async def put(self, page, size):
+        import asyncio
+        await asyncio.Event().wait()
+
+    async def close(self):
+        pass
+
+
+def check_capture():
+    import asyncio
+    import os
+    from capture import Capture, ListSink
+    from main import intercept_xhr
+
+    fixture = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'parsers', 'item_list', 'page_full.json')
+    with open(fixture, encoding='utf-8') as f:
+        body = f.read()
+    url = "https://www.tiktok.com/api/post/item_list/?secUid=x&cursor=0"
+
+    async def scenario():
+        page = FakeRoutePage()
+        sink = ListSink()
+        capture = await intercept_xhr(page, capture=Capture(sink))
+        assert await page.serve(FakeRoute(url, body)) == "fulfilled"
+        assert await page.serve(FakeRoute("https://www.tiktok.com/static/app.js")) == "continued"
+        assert capture.pages == 1 and len(sink.pages) == 1, capture.summary()
+        reduced = sink.pages[0]["response_body"]
+        assert set(reduced) == {"itemList", "hasMore", "cursor"} and reduced["itemList"], reduced
+
+        # A sink that stops consuming must not hold the intercepted request forever
+        page = FakeRoutePage()
+        capture = await intercept_xhr(page, capture=Capture(StalledSink(), sink_timeout=0.05))
+        outcome = await asyncio.wait_for(page.serve(FakeRoute(url, body)), 5)
+        assert outcome == "fulfilled" and capture.dropped == 1 and capture.pages == 0, capture.summary()
+
+    asyncio.run(scenario())
+
+
+def check_browser_state_identity():
+    import tempfile
+    import time
+    from browser_state import StorageStateCache, REQUIRED_COOKIES
+    from rate_limiter import rate_limiter, BLOCKED
+
+    class BrowserMobClient:
+        proxy = "localhost:8081"
+        upstream = "10.0.0.7:3128"
+
+    relay = BrowserMobClient()
+    state = {"cookies": [{"name": name, "value": "v", "domain": ".tiktok.com", "expires": time.time() + 3600}
+                         for name in REQUIRED_COOKIES], "origins": []}
+    with tempfile.TemporaryDirectory() as root:
+        cache = StorageStateCache(root=root)
+        assert cache.save(relay, state)
+        # Stored and refreshed under the upstream the page egresses through, never the listener port
+        assert cache.get("10.0.0.7:3128") == state and cache.get("localhost:8081") is None
+        assert cache._identities == {"10.0.0.7:3128"}
+        # A block recorded for the relay flags the identity its cookies are stored under
+        for _ in range(20):
+            rate_limiter.record(relay, "profile", BLOCKED)
+        assert rate_limiter.is_flagged("10.0.0.7:3128") and not cache.save(relay, state)
+
+
+CHECKS = [
+    ("retry_classification", check_retry_classification),
+    ("block_detection", check_block_detection),
+    ("scroll_engine", check_scroll_engine),
+    ("capture", check_capture),
+    ("browser_state_identity", check_browser_state_identity),
+]
+
+
+def run(only=None):
+    for name in ('main_logger', 'scraper_logger'):
+        logging.getLogger(name).addHandler(logging.NullHandler())
+        logging.getLogger(name).propagate = False
+    failures = 0
+    for name, check in CHECKS:
+        if only and name not in only:
+            continue
+        try:
+            check()
+        except Exception:
+            failures += 1
+            print(f"FAIL {name}")
+            traceback.print_exc()
+        else:
+            print(f"ok   {name}")
+    return 1 if failures else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--only', action='append', help="restrict to a check, may be repeated")
+    args = parser.parse_args()
+    sys.exit(run(only=args.only))
+
+
+if __name__ == '__main__':
+    main()
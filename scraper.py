@@ -1,9 +1,37 @@
-import requests
-from selenium import webdriver
 import logging
+import os
+import threading
 
 logger = logging.getLogger(__name__)
 
+HTTP_POOL_SIZE = int(os.environ.get('HTTP_POOL_SIZE', '32'))
+
+BROWSER_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,image/apng,*/*;q=0.8",
+    "Accept-Language": "en-US,en;q=0.9",
+    "Accept-Encoding": "gzip, deflate",
+}
+
+_http_session = None
+_http_session_lock = threading.Lock()
+
+def get_http_session():
+    """Shared requests session with a connection pool sized for concurrent fetches"""
+    global _http_session
+    with _http_session_lock:
+        if _http_session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers.update(BROWSER_HEADERS)
+            _http_session = session
+        return _http_session
+
 def get_formatted_proxy_url(proxy):
     """Format proxy URL to include scheme"""
     if not proxy:
@@ -28,6 +56,8 @@ def setup_proxy_config(proxy):
     }
 
 def initialize_driver(proxy):
+    from selenium import webdriver
+
     options = webdriver.ChromeOptions()
     if proxy:
         proxy_url = get_formatted_proxy_url(proxy)
@@ -35,6 +65,8 @@ def initialize_driver(proxy):
     # ... rest of the function
 
 def scrape_tiktok_profile(url, proxy=None):
+    import requests
+
     try:
         proxy_config = setup_proxy_config(proxy)
         response = requests.get(url, proxies=proxy_config)
@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import os
+
+logger = logging.getLogger('scraper_logger')
+
+SCROLL_TARGET_PAGES = int(os.environ.get('SCROLL_TARGET_PAGES', '15'))  # item_list pages to load
+SCROLL_MAX_IDLE_ROUNDS = int(os.environ.get('SCROLL_MAX_IDLE_ROUNDS', '3'))
+SCROLL_MIN_WAIT = float(os.environ.get('SCROLL_MIN_WAIT', '1.5'))  # seconds
+SCROLL_MAX_WAIT = float(os.environ.get('SCROLL_MAX_WAIT', '8'))
+SCROLL_MIN_STEP = 0.5  # in viewport heights
+SCROLL_MAX_STEP = 4.0
+NEAR_BOTTOM_VIEWPORTS = 1.5  # start waiting for new content this close to the end of the page
+
+# Counts DOM insertions so the engine can tell "content arrived" from "nothing happened".
+# Installed once per page; these are plain functions, no top-level await goes through evaluate.
+INSTALL_OBSERVER = """() => {
+    if (window.__scrollSignal) return;
+    window.__scrollSignal = {mutations: 0};
+    new MutationObserver(records => {
+        window.__scrollSignal.mutations += records.length;
+    }).observe(document.body, {childList: true, subtree: true});
+}"""
+READ_POSITION = """() => ({
+    mutations: window.__scrollSignal ? window.__scrollSignal.mutations : 0,
+    scrollY: window.scrollY,
+    viewport: window.innerHeight,
+    height: document.documentElement.scrollHeight
+})"""
+SCROLL_BY = "(dy) => window.scrollBy(0, dy)"
+MUTATED_SINCE = "(count) => window.__scrollSignal && window.__scrollSignal.mutations > count"
+
+
+def is_item_list_response(response):
+    return "api/post/item_list" in response.url
+
+
+class ScrollEngine:
+    """Scroll a profile page until ``target_pages`` item_list pages have loaded.
+
+    Each round scrolls by a multiple of the viewport height, then waits for
+    the next item_list response or, failing that, new DOM nodes. Fast loads
+    grow the step and shorten the wait; slow or empty rounds shrink them, so
+    the time spent follows how much content the profile actually has.
+    """
+
+    def __init__(self, page, target_pages=SCROLL_TARGET_PAGES, should_stop=None,
+                 max_idle_rounds=SCROLL_MAX_IDLE_ROUNDS):
+        self.page = page
+        self.target_pages = target_pages
+        self.should_stop = should_stop
+        self.max_idle_rounds = max_idle_rounds
+        self.step = 1.0
+        self.wait = SCROLL_MAX_WAIT / 2
+        self.pages_loaded = 0
+        self.rounds = 0
+
+    async def _wait_for_content(self, mutations):
+        """Return 'response', 'mutation' or None depending on what showed up first"""
+        timeout = self.wait * 1000
+        waiters = {
+            asyncio.ensure_future(self.page.wait_for_event(
+                "response", predicate=is_item_list_response, timeout=timeout)): "response",
+            asyncio.ensure_future(self.page.wait_for_function(
+                MUTATED_SINCE, arg=mutations, polling=100, timeout=timeout)): "mutation",
+        }
+        try:
+            done, _ = await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+            if any(waiters[task] == "mutation" for task in done) and len(done) == 1:
+                # DOM changes usually precede the data request by a little; give it a moment
+                response_task = next(task for task, kind in waiters.items() if kind == "response")
+                await asyncio.wait({response_task}, timeout=min(1.0, self.wait))
+                done = {task for task in waiters if task.done()}
+            kinds = {waiters[task] for task in done if not task.cancelled() and task.exception() is None}
+        finally:
+            for task in waiters:
+                task.cancel()
+            await asyncio.gather(*waiters, return_exceptions=True)
+        if "response" in kinds:
+            return "response"
+        if "mutation" in kinds:
+            return "mutation"
+        return None
+
+    def _adapt(self, signal, elapsed):
+        if signal == "response" and elapsed < self.wait / 2:
+            self.step = min(SCROLL_MAX_STEP, self.step * 1.5)
+        elif signal is None or elapsed > self.wait * 0.8:
+            self.step = max(SCROLL_MIN_STEP, self.step / 2)
+        if signal == "response":
+            # Wait about three times as long as content currently takes to arrive
+            self.wait = min(SCROLL_MAX_WAIT, max(SCROLL_MIN_WAIT, elapsed * 3))
+        elif signal is None:
+            self.wait = min(SCROLL_MAX_WAIT, self.wait * 1.5)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        await self.page.evaluate(INSTALL_OBSERVER)
+        idle_rounds = 0
+        max_rounds = self.target_pages * 20
+        while self.pages_loaded < self.target_pages and idle_rounds < self.max_idle_rounds:
+            if self.should_stop and self.should_stop():
+                logger.info("Scroll engine: no more pages available")
+                break
+            if self.rounds >= max_rounds:
+                logger.warning(f"Scroll engine: stopping after {self.rounds} rounds")
+                break
+            self.rounds += 1
+
+            position = await self.page.evaluate(READ_POSITION)
+            started = loop.time()
+            await self.page.evaluate(SCROLL_BY, int(position["viewport"] * self.step))
+            after = await self.page.evaluate(READ_POSITION)
+            remaining = after["height"] - (after["scrollY"] + after["viewport"])
+            if remaining > after["viewport"] * NEAR_BOTTOM_VIEWPORTS:
+                # Still scrolling through content that is already loaded, nothing to wait for
+                continue
+
+            signal = await self._wait_for_content(position["mutations"])
+            elapsed = loop.time() - started
+            self._adapt(signal, elapsed)
+
+            if signal == "response":
+                self.pages_loaded += 1
+                idle_rounds = 0
+            elif remaining <= 2:
+                # At the bottom without a new item_list page; DOM churn alone (ads, video
+                # previews, counters) is not progress, so mutations don't reset the count
+                idle_rounds += 1
+            logger.debug(f"Scroll round {self.rounds}: {signal or 'nothing'} in {elapsed:.2f}s, "
+                         f"step {self.step:.2f} viewports, wait {self.wait:.2f}s")
+
+        logger.info(f"Scroll engine finished: {self.pages_loaded} pages in {self.rounds} rounds")
+        return {"pages": self.pages_loaded, "rounds": self.rounds}
+
+    async def settle(self, quiet=SCROLL_MIN_WAIT, timeout=SCROLL_MAX_WAIT):
+        """Wait until no item_list response has arrived for ``quiet`` seconds, at most ``timeout``"""
+        from playwright.async_api import TimeoutError as PlaywrightTimeoutError
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while loop.time() < deadline:
+            try:
+                await self.page.wait_for_event("response", predicate=is_item_list_response,
+                                               timeout=min(quiet, deadline - loop.time()) * 1000)
+            except PlaywrightTimeoutError:
+                return
@@ -0,0 +1,79 @@
+"""Limiter, browser and stats state shared by the API process and its scrape worker processes.
+
+In process mode the API process serves its rate limiter, retry budget,
+browser state cache and stats store on a local multiprocessing manager socket
+before it starts the worker pool. Worker processes find the socket in their
+environment and use proxies to those objects instead of building their own,
+so throttling, block flags and the retry budget cover every process, blocks a
+worker runs into reach the scheduler and /metrics of the API process, and
+only the API process writes the stats files.
+"""
+import json
+import os
+import threading
+from multiprocessing.managers import BaseManager
+
+SHARED_STATE_ENV = 'SCRAPER_SHARED_STATE'
+
+# Methods worker processes may call on each shared object
+EXPOSED = {
+    "rate_limiter": ("_reserve", "record", "is_flagged", "flagged_share", "snapshot"),
+    "retry_budget": ("record_request", "try_retry", "snapshot"),
+    "state_cache": ("get", "save", "invalidate", "age"),
+    "stats_store": ("record_posts",),
+}
+
+
+class _StateManager(BaseManager):
+    pass
+
+
+_server = None
+_manager = None
+_lock = threading.Lock()
+
+
+def serve():
+    """Serve this process's shared objects to processes started from now on"""
+    global _server
+    with _lock:
+        if _server is not None:
+            return
+        from browser_state import state_cache
+        from rate_limiter import rate_limiter
+        from retry_policy import retry_budget
+        from stats_store import get_stats_store
+
+        shared = {"rate_limiter": lambda: rate_limiter, "retry_budget": lambda: retry_budget,
+                  "state_cache": lambda: state_cache, "stats_store": get_stats_store}
+        for name, factory in shared.items():
+            _StateManager.register(name, callable=factory, exposed=EXPOSED[name])
+        _server = _StateManager(authkey=os.urandom(32)).get_server()
+        threading.Thread(target=_server.serve_forever, name="shared-state", daemon=True).start()
+        # Spawned workers inherit the environment; the pid keeps this process from connecting to itself
+        os.environ[SHARED_STATE_ENV] = json.dumps({
+            "pid": os.getpid(),
+            "address": _server.address,
+            "authkey": bytes(_server.authkey).hex(),
+        })
+
+
+def remote(name):
+    """Proxy for the API process's ``name`` object inside a worker process, else None"""
+    global _manager
+    config = os.environ.get(SHARED_STATE_ENV)
+    if not config:
+        return None
+    config = json.loads(config)
+    if config["pid"] == os.getpid():
+        return None
+    with _lock:
+        if _manager is None:
+            for shared_name, methods in EXPOSED.items():
+                _StateManager.register(shared_name, exposed=methods)
+            address = config["address"]
+            address = tuple(address) if isinstance(address, list) else address
+            manager = _StateManager(address=address, authkey=bytes.fromhex(config["authkey"]))
+            manager.connect()
+            _manager = manager
+    return getattr(_manager, name)()
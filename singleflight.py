@@ -0,0 +1,110 @@
+import asyncio
+import json
+import logging
+import os
+import time
+
+logger = logging.getLogger('main_logger')
+
+# Seconds a finished result keeps being handed to identical requests; 0 only coalesces in-flight calls
+SCRAPE_FRESHNESS_WINDOW = float(os.environ.get('SCRAPE_FRESHNESS_WINDOW', '30'))
+
+
+def request_key(*parts, **options):
+    """Build a hashable key from the username and the options that change the result"""
+    return json.dumps([parts, options], sort_keys=True, default=str)
+
+
+class SingleFlight:
+    """Coalesce concurrent identical async calls onto one shared task.
+
+    Callers wait on the shared task through ``asyncio.shield``, so a client that
+    disconnects cancels only its own wait, never the work the others share.
+    Successful results are reused for ``freshness`` seconds after they finish.
+
+    Results with ``retain()`` / ``release()`` (worker_pool.SharedResult) are
+    reference counted: every caller that gets one back owns a reference and
+    must release it, and the freshness cache holds one until it evicts it.
+    """
+
+    def __init__(self, freshness=SCRAPE_FRESHNESS_WINDOW):
+        self.freshness = freshness
+        self._in_flight = {}
+        self._waiters = {}
+        self._results = {}
+
+    def _fresh_result(self, key, now):
+        entry = self._results.get(key)
+        if entry is None:
+            return None
+        if now - entry[0] > self.freshness:
+            del self._results[key]
+            _release(entry[1])
+            return None
+        return entry
+
+    async def do(self, key, fn):
+        """Return ``await fn()``, sharing the call with identical in-flight or recent requests"""
+        now = time.monotonic()
+        cached = self._fresh_result(key, now)
+        if cached is not None:
+            logger.info(f"Serving {key} from a result {now - cached[0]:.1f}s old")
+            _retain(cached[1], 1)
+            return cached[1]
+
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda done: self._finish(key, done))
+        else:
+            logger.info(f"Attaching to in-flight request for {key}")
+        self._waiters[key] = self._waiters.get(key, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if self._in_flight.get(key) is task:
+                # Gave up before the result was handed out, so no reference is taken for us
+                self._waiters[key] -= 1
+            elif task.done() and not task.cancelled() and task.exception() is None:
+                _release(task.result())
+            raise
+
+    def _finish(self, key, task):
+        self._in_flight.pop(key, None)
+        waiters = self._waiters.pop(key, 0)
+        if task.cancelled() or task.exception() is not None:
+            # Failures are not cached, the next request starts a fresh attempt
+            return
+        result = task.result()
+        cache = self.freshness > 0
+        # One reference per waiting caller and one for the cache, replacing the task's own
+        _retain(result, waiters + cache)
+        _release(result)
+        if cache:
+            previous = self._results.get(key)
+            self._results[key] = (time.monotonic(), result)
+            if previous is not None:
+                _release(previous[1])
+            self._prune()
+
+    def _prune(self):
+        now = time.monotonic()
+        for key in [key for key, (finished_at, _) in self._results.items() if now - finished_at > self.freshness]:
+            _release(self._results.pop(key)[1])
+
+    def in_flight(self):
+        return len(self._in_flight)
+
+
+def _retain(result, count):
+    if count and hasattr(result, 'retain'):
+        result.retain(count)
+
+
+def _release(result):
+    if hasattr(result, 'release'):
+        result.release()
+
+
+scrape_flight = SingleFlight()
@@ -0,0 +1,217 @@
+import json
+import logging
+import os
+import threading
+import time
+
+import shared_state
+
+logger = logging.getLogger('main_logger')
+
+STATS_STORE_DIR = os.environ.get('STATS_STORE_DIR', 'stats_store')
+# Log entries written since the last snapshot before the log is folded into a new one
+STATS_COMPACT_EVERY = int(os.environ.get('STATS_COMPACT_EVERY', '5000'))
+
+
+def _creator_of(post):
+    author = post.get("author")
+    if isinstance(author, dict):
+        return author.get("uniqueId")
+    return author if isinstance(author, str) else None
+
+
+class StatsStore:
+    """Change-only time series of video ``stats``, keyed by video id.
+
+    Every observation that changes at least one counter is appended to
+    ``log.jsonl`` with only the changed counters; unchanged polls write
+    nothing. Every ``compact_every`` entries the log is folded into
+    ``snapshot.json``, which holds one columnar series per video (a ``ts``
+    column plus one column per counter, ``null`` where the counter did not
+    change) and an index of video ids by creator.
+
+    Timestamps are taken under the store lock and never go backwards, so
+    concurrent recorders and wall clock steps cannot reorder a series. Log
+    entries carry the generation of the log they were written to; the
+    snapshot records the first generation it does not contain, which is how a
+    replay skips entries a crash left behind after they were already folded in.
+    """
+
+    def __init__(self, root=STATS_STORE_DIR, compact_every=STATS_COMPACT_EVERY):
+        self.root = root
+        self.compact_every = compact_every
+        self._lock = threading.Lock()
+        self._snapshot_path = os.path.join(root, "snapshot.json")
+        self._log_path = os.path.join(root, "log.jsonl")
+        self._videos = {}
+        self._creators = {}
+        self._latest = {}
+        self._log_entries = 0
+        self._log = None
+        self._generation = 0
+        self._last_ts = 0.0
+        os.makedirs(root, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self._snapshot_path) as f:
+                snapshot = json.load(f)
+            self._videos = snapshot["videos"]
+            self._generation = snapshot.get("generation", 0)
+            self._creators = {creator: set(ids) for creator, ids in snapshot["creators"].items()}
+            for video_id, series in self._videos.items():
+                self._latest[video_id] = self._state_at(series, len(series["ts"]))
+                if series["ts"]:
+                    self._last_ts = max(self._last_ts, series["ts"][-1])
+        except (FileNotFoundError, json.JSONDecodeError, KeyError):
+            pass
+        try:
+            with open(self._log_path) as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        # Torn last line from a crash mid-append
+                        continue
+                    if entry.get("g", self._generation) < self._generation:
+                        # Already folded into the snapshot before a crash interrupted the log truncation
+                        continue
+                    self._apply(entry["v"], entry.get("c"), entry["t"], entry["s"])
+                    self._last_ts = max(self._last_ts, entry["t"])
+                    self._log_entries += 1
+        except FileNotFoundError:
+            pass
+        logger.info(f"Loaded stats for {len(self._videos)} videos, {self._log_entries} log entries to compact")
+
+    @staticmethod
+    def _state_at(series, rows):
+        state = {}
+        for field, column in series["columns"].items():
+            for value in reversed(column[:rows]):
+                if value is not None:
+                    state[field] = value
+                    break
+        return state
+
+    def _apply(self, video_id, creator, ts, changes):
+        series = self._videos.get(video_id)
+        if series is None:
+            series = self._videos[video_id] = {"creator": creator, "ts": [], "columns": {}}
+        if creator and not series["creator"]:
+            series["creator"] = creator
+        if series["creator"]:
+            self._creators.setdefault(series["creator"], set()).add(video_id)
+        rows = len(series["ts"])
+        series["ts"].append(ts)
+        for field, value in changes.items():
+            series["columns"].setdefault(field, [None] * rows)
+        for field, column in series["columns"].items():
+            column.append(changes.get(field))
+        self._latest.setdefault(video_id, {}).update(changes)
+
+    def record(self, video_id, stats, creator=None, ts=None):
+        """Record a stats observation; returns True if anything changed"""
+        return self.record_many([(video_id, stats, creator)], ts=ts) == 1
+
+    def record_many(self, observations, ts=None):
+        """Record ``(video_id, stats, creator)`` tuples with one log write; returns how many changed"""
+        lines = []
+        with self._lock:
+            # Taken under the lock and clamped, so series stay ordered whatever order threads get here in
+            ts = max(time.time() if ts is None else ts, self._last_ts)
+            self._last_ts = ts
+            for video_id, stats, creator in observations:
+                if not video_id or not isinstance(stats, dict):
+                    continue
+                video_id = str(video_id)
+                latest = self._latest.get(video_id, {})
+                changes = {field: value for field, value in stats.items()
+                           if value is not None and latest.get(field) != value}
+                if not changes:
+                    continue
+                self._apply(video_id, creator, ts, changes)
+                lines.append(json.dumps({"v": video_id, "c": creator, "t": ts, "g": self._generation,
+                                         "s": changes}) + "\n")
+            if lines:
+                if self._log is None:
+                    self._log = open(self._log_path, "a")
+                self._log.write("".join(lines))
+                self._log.flush()
+                self._log_entries += len(lines)
+                if self._log_entries >= self.compact_every:
+                    self._compact()
+        return len(lines)
+
+    def record_posts(self, posts, ts=None):
+        """Record the stats of parse_item results"""
+        return self.record_many([(post.get("id"), post.get("stats"), _creator_of(post)) for post in posts], ts=ts)
+
+    def compact(self):
+        with self._lock:
+            self._compact()
+
+    def _compact(self):
+        started = time.monotonic()
+        tmp_path = self._snapshot_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({
+                "compacted_at": time.time(),
+                "generation": self._generation + 1,
+                "videos": self._videos,
+                "creators": {creator: sorted(ids) for creator, ids in self._creators.items()},
+            }, f, separators=(",", ":"))
+        os.replace(tmp_path, self._snapshot_path)
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+        # Entries written before a crash here are skipped on replay by their generation
+        open(self._log_path, "w").close()
+        self._generation += 1
+        logger.info(f"Compacted {self._log_entries} stats log entries into snapshot "
+                    f"in {time.monotonic() - started:.2f}s")
+        self._log_entries = 0
+
+    def query(self, video_id, start=None, end=None):
+        """Return the changes to a video's stats between ``start`` and ``end`` (epoch seconds).
+
+        Each point carries the full stats as of that time and the counters that
+        changed; ``baseline`` is the state just before ``start``.
+        """
+        with self._lock:
+            series = self._videos.get(str(video_id))
+            if series is None:
+                return None
+            state, baseline, points = {}, {}, []
+            for row, ts in enumerate(series["ts"]):
+                if end is not None and ts > end:
+                    break
+                changed = {field: column[row] for field, column in series["columns"].items()
+                           if column[row] is not None}
+                state.update(changed)
+                if start is not None and ts < start:
+                    baseline = dict(state)
+                    continue
+                points.append({"ts": ts, "stats": dict(state), "changed": sorted(changed)})
+            return {"video_id": str(video_id), "creator": series["creator"], "baseline": baseline, "points": points}
+
+    def videos_for_creator(self, creator):
+        with self._lock:
+            return sorted(self._creators.get(creator, ()))
+
+
+_stats_store = None
+_stats_store_lock = threading.Lock()
+
+
+def get_stats_store():
+    global _stats_store
+    with _stats_store_lock:
+        if _stats_store is None:
+            # Worker processes record into the API process's store, which owns the files
+            _stats_store = shared_state.remote("stats_store") or StatsStore()
+        return _stats_store
+
+
+def stats_store_loaded():
+    return _stats_store is not None
@@ -0,0 +1,231 @@
+import asyncio
+import contextvars
+import functools
+import json
+import logging
+import os
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+logger = logging.getLogger('main_logger')
+
+TRACE_ENABLED = os.environ.get('TRACE_ENABLED', '1') == '1'
+TRACE_DIR = os.environ.get('TRACE_DIR', 'traces')
+# Only write traces for requests at least this slow (seconds); 0 writes every request
+TRACE_MIN_DURATION = float(os.environ.get('TRACE_MIN_DURATION', '10'))
+TRACE_MAX_EVENTS = int(os.environ.get('TRACE_MAX_EVENTS', '20000'))
+# Oldest trace files are deleted once the directory holds more than this many
+TRACE_MAX_FILES = int(os.environ.get('TRACE_MAX_FILES', '200'))
+
+# Client-supplied ids end up in file names and log lines, so only plain tokens are accepted
+REQUEST_ID_PATTERN = re.compile(r'^[A-Za-z0-9_-]{1,64}$')
+
+request_id_var = contextvars.ContextVar('request_id', default='-')
+_trace_var = contextvars.ContextVar('trace', default=None)
+
+# Chrome trace timestamps are microseconds; anchor a monotonic clock to wall time once
+_WALL_ORIGIN = time.time() * 1e6
+_PERF_ORIGIN = time.perf_counter()
+
+
+def _now_us():
+    return _WALL_ORIGIN + (time.perf_counter() - _PERF_ORIGIN) * 1e6
+
+
+def _lane():
+    """Identify the task or thread recording a span, with a readable name for it"""
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    if task is not None:
+        return id(task), f"task {task.get_name()}"
+    thread = threading.current_thread()
+    return thread.ident, f"thread {thread.name}"
+
+
+class Trace:
+    """Spans recorded for one request, exported as Chrome trace-event JSON.
+
+    Every asyncio task and thread that works on the request gets its own lane
+    (``tid``), so overlapping work such as concurrent XHRs shows up side by
+    side in chrome://tracing or Perfetto instead of as broken nesting.
+    """
+
+    def __init__(self, request_id, name):
+        self.request_id = request_id
+        self.name = name
+        self.events = []
+        self.dropped = 0
+        self._lanes = {}
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _tid(self):
+        key, label = _lane()
+        tid = self._lanes.get(key)
+        if tid is None:
+            tid = len(self._lanes) + 1
+            self._lanes[key] = tid
+            self.events.append({"name": "thread_name", "ph": "M", "pid": self._pid, "tid": tid,
+                                "args": {"name": label}})
+        return tid
+
+    def add(self, name, start_us, duration_us, args):
+        with self._lock:
+            if len(self.events) >= TRACE_MAX_EVENTS:
+                self.dropped += 1
+                return
+            self.events.append({"name": name, "ph": "X", "ts": round(start_us, 1), "dur": round(duration_us, 1),
+                                "pid": self._pid, "tid": self._tid(), "args": args})
+
+    def duration(self):
+        spans = [event for event in self.events if event["ph"] == "X"]
+        if not spans:
+            return 0.0
+        return (max(e["ts"] + e["dur"] for e in spans) - min(e["ts"] for e in spans)) / 1e6
+
+    def export(self, directory=TRACE_DIR):
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{self.request_id}.json")
+        with self._lock:
+            data = {
+                "traceEvents": [{"name": "process_name", "ph": "M", "pid": self._pid,
+                                 "args": {"name": f"tiktok-scraper {self._pid}"}}] + self.events,
+                "displayTimeUnit": "ms",
+                "otherData": {"request_id": self.request_id, "dropped_events": self.dropped},
+            }
+        with open(path + ".tmp", "w") as f:
+            json.dump(data, f)
+        os.replace(path + ".tmp", path)
+        _rotate(directory)
+        return path
+
+
+def _rotate(directory, max_files=TRACE_MAX_FILES):
+    entries = []
+    for entry in os.scandir(directory):
+        if entry.name.endswith(".json"):
+            try:
+                entries.append((entry.stat().st_mtime, entry.path))
+            except FileNotFoundError:
+                pass
+    if len(entries) <= max_files:
+        return
+    entries.sort()
+    for _, path in entries[:len(entries) - max_files]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def new_request_id():
+    return uuid.uuid4().hex[:16]
+
+
+def valid_request_id(request_id):
+    """Return ``request_id`` if it is a safe token, else None"""
+    if request_id and REQUEST_ID_PATTERN.match(request_id):
+        return request_id
+    return None
+
+
+def current_request_id():
+    return request_id_var.get()
+
+
+@contextmanager
+def start_trace(name, request_id=None, **args):
+    """Run the block as the root span of a new request trace and export it afterwards"""
+    request_id = valid_request_id(request_id) or new_request_id()
+    id_token = request_id_var.set(request_id)
+    trace = Trace(request_id, name) if TRACE_ENABLED else None
+    trace_token = _trace_var.set(trace)
+    try:
+        with span(name, request_id=request_id, **args) as info:
+            yield info
+    finally:
+        _trace_var.reset(trace_token)
+        if trace is not None and trace.duration() >= TRACE_MIN_DURATION:
+            try:
+                path = trace.export()
+                logger.debug(f"Wrote trace to {path}")
+            except OSError as e:
+                logger.error(f"Could not write trace: {e}")
+        request_id_var.reset(id_token)
+
+
+@contextmanager
+def span(name, **args):
+    """Time the block as a span of the current request; a no-op outside a trace.
+
+    Yields the span's ``args`` dict so callers can attach results (status codes,
+    item counts) once they are known.
+    """
+    trace = _trace_var.get()
+    if trace is None:
+        yield args
+        return
+    start = _now_us()
+    try:
+        yield args
+    except BaseException as e:
+        args["error"] = type(e).__name__
+        raise
+    finally:
+        trace.add(name, start, _now_us() - start, args)
+
+
+def traced(name=None):
+    """Decorator form of span() for sync and async functions"""
+    def decorator(fn):
+        span_name = name or fn.__name__
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with span(span_name):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _trace_var.get() is None:
+                return fn(*args, **kwargs)
+            with span(span_name):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def bind(fn, *args, **kwargs):
+    """Return a callable that runs ``fn`` in the current context, for run_in_executor"""
+    return functools.partial(contextvars.copy_context().run, fn, *args, **kwargs)
+
+
+def capture():
+    """Snapshot the request id and trace for callbacks that run outside the request's context"""
+    return request_id_var.get(), _trace_var.get()
+
+
+@contextmanager
+def restore(captured):
+    request_id, trace = captured
+    id_token = request_id_var.set(request_id)
+    trace_token = _trace_var.set(trace)
+    try:
+        yield
+    finally:
+        _trace_var.reset(trace_token)
+        request_id_var.reset(id_token)
+
+
+class RequestIdFilter(logging.Filter):
+    """Stamp every record with the id of the request it was logged for"""
+
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
@@ -0,0 +1,152 @@
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+
+import shared_state
+
+logger = logging.getLogger('main_logger')
+
+# 'inline' runs scrapes in the API process, 'process' hands them to the pool below
+SCRAPE_POOL_MODE = os.environ.get('SCRAPE_POOL_MODE', 'inline').lower()
+SCRAPE_WORKERS_PER_CORE = float(os.environ.get('SCRAPE_WORKERS_PER_CORE', '1'))
+STREAM_CHUNK_SIZE = int(os.environ.get('STREAM_CHUNK_SIZE', str(64 * 1024)))
+
+
+def worker_count(per_core=None):
+    per_core = SCRAPE_WORKERS_PER_CORE if per_core is None else per_core
+    return max(1, int((os.cpu_count() or 1) * per_core))
+
+
+def write_shared_result(result):
+    """Serialize ``result`` into a new shared memory segment and return (name, size)"""
+    payload = json.dumps(result).encode('utf-8')
+    segment = shared_memory.SharedMemory(create=True, size=max(1, len(payload)))
+    segment.buf[:len(payload)] = payload
+    name = segment.name
+    segment.close()
+    # Ownership moves to the API process, which unlinks the segment once it has been streamed
+    resource_tracker.unregister(segment._name, 'shared_memory')
+    return name, len(payload)
+
+
+def _scrape_worker(username):
+    # Imported here so the engines are loaded inside the worker, not pickled across
+    import main
+    main.configure_logging()
+    result = main.setup_and_scrape(username)
+    if not result:
+        raise main.ScrapeError("Failed to scrape TikTok profile")
+    # Recorded here, through the API process's stats store, while the result is still decoded
+    try:
+        main.record_scrape_stats(result)
+    except Exception as e:
+        logger.error(f"Could not record stats for {username}: {str(e)}")
+    return write_shared_result(result)
+
+
+def _synthetic_worker(item_count, shared):
+    """Benchmark payload shaped like a scrape result with ``item_count`` captured pages"""
+    result = {
+        "username": "benchmark",
+        "follower_count": "0",
+        "videos": [],
+        "xhr_data": [
+            {
+                "url": f"https://www.tiktok.com/api/post/item_list/?cursor={i}",
+                "method": "GET",
+                "response_status": 200,
+                "response_body": {
+                    "itemList": [
+                        {"id": str(i * 100 + j), "desc": "x" * 200, "stats": {"playCount": j, "diggCount": j}}
+                        for j in range(30)
+                    ],
+                    "hasMore": True,
+                    "cursor": str(i),
+                },
+            }
+            for i in range(item_count)
+        ],
+    }
+    return write_shared_result(result) if shared else result
+
+
+class SharedResult:
+    """A scrape result living in a shared memory segment written by a worker.
+
+    The encoded JSON is streamed from the segment to each response, so the API
+    process never holds a full copy of it or decodes it. The segment is
+    reference counted: every holder (each coalesced response and the
+    freshness cache, see SingleFlight) calls ``release()`` once, and the last
+    one unlinks it.
+    """
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = size
+        self._segment = shared_memory.SharedMemory(name=name)
+        self._refs = 1
+        self._lock = threading.Lock()
+
+    def retain(self, count=1):
+        with self._lock:
+            if self._segment is None:
+                raise ValueError(f"Shared result {self.name} was already released")
+            self._refs += count
+
+    def iter_chunks(self, chunk_size=STREAM_CHUNK_SIZE):
+        """Yield the JSON payload in chunks; the caller still owns, and must release, its reference"""
+        for start in range(0, self.size, chunk_size):
+            with self._lock:
+                if self._segment is None:
+                    raise ValueError(f"Shared result {self.name} was released while being read")
+                chunk = bytes(self._segment.buf[start:min(start + chunk_size, self.size)])
+            yield chunk
+
+    def release(self):
+        with self._lock:
+            self._refs -= 1
+            if self._refs > 0 or self._segment is None:
+                return
+            self._segment.close()
+            self._segment.unlink()
+            self._segment = None
+
+
+class WorkerPool:
+    """Spawned process pool whose workers hand results back through shared memory.
+
+    Workers use the API process's rate limiter, retry budget and browser state
+    cache through shared_state rather than their own copies.
+    """
+
+    def __init__(self, workers=None):
+        self.workers = workers or worker_count()
+        self._executor = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            logger.info(f"Starting scrape worker pool with {self.workers} processes")
+            shared_state.serve()
+            # Spawned, not forked: the API process already runs threads that may hold locks
+            self._executor = ProcessPoolExecutor(max_workers=self.workers,
+                                                 mp_context=multiprocessing.get_context('spawn'))
+        return self._executor
+
+    async def submit(self, username):
+        loop = asyncio.get_running_loop()
+        name, size = await loop.run_in_executor(self._get_executor(), _scrape_worker, username)
+        logger.debug(f"Worker result for {username}: {size} bytes in segment {name}")
+        return SharedResult(name, size)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+worker_pool = WorkerPool()